@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Headless benchmarks of the add-on, outside of Anki. The aqt/anki modules are
+replaced by stubs, and the add-on is run from a temporary copy so it can
+build its database from scratch.
+
+Usage: python benchmark.py [--accdb ACCDB_unicode.csv] [--mecab DIR] [--output results.json]
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+
+
+# ************************************************
+#                 Anki stubs                     *
+# ************************************************
+class Stub(object):
+    """ Accepts any attribute access or call """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return Stub()
+
+    def __call__(self, *args, **kwargs):
+        return Stub()
+
+
+class AddonManager(object):
+
+    def __init__(self, config):
+        self.config = config
+
+    def getConfig(self, name):
+        return dict(self.config)
+
+    def setConfigUpdatedAction(self, name, action):
+        pass
+
+
+class Progress(object):
+
+    def start(self, *args, **kwargs):
+        pass
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Note(dict):
+
+    def __init__(self, model, fields):
+        dict.__init__(self, fields)
+        self._model = model
+
+    def model(self):
+        return self._model
+
+    def flush(self):
+        pass
+
+
+class Collection(object):
+    """ Just enough of a collection for regeneratePronunciations """
+
+    def __init__(self, notes):
+        self.notes = notes
+        self.media = Stub()
+        self.media.strip = lambda txt: txt
+
+    def getNote(self, nid):
+        return self.notes[nid]
+
+
+def install_stubs(config):
+    """ Register fake aqt, anki and PyQt5 modules, and return the fake mw """
+    mw = Stub()
+    mw.addonManager = AddonManager(config)
+    mw.progress = Progress()
+    mw.checkpoint = lambda name: None
+    mw.reset = lambda: None
+
+    modules = {
+        "aqt": {"mw": mw},
+        "aqt.qt": {"QMenu": Stub, "QAction": Stub, "QFileDialog": Stub},
+        "aqt.utils": {"isMac": sys.platform == "darwin", "isWin": sys.platform == "win32",
+                      "showInfo": lambda *args, **kwargs: None, "showText": lambda *args, **kwargs: None},
+        "anki": {},
+        "anki.hooks": {"addHook": lambda *args: None},
+        "PyQt5": {},
+        "PyQt5.QtWidgets": {},
+    }
+    for name, attrs in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        module.__all__ = list(attrs)
+        sys.modules[name] = module
+
+    return mw
+
+
+# ************************************************
+#                 Benchmarks                     *
+# ************************************************
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    ret = func(*args, **kwargs)
+    return time.perf_counter() - start, ret
+
+
+def import_addon(path):
+    """ Import (or re-import) the add-on from path, which runs all startup work """
+    sys.modules.pop("nhk_pronunciation", None)
+    sys.modules.pop("nhk_pronunciation_core", None)
+    spec = importlib.util.spec_from_file_location("nhk_pronunciation", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["nhk_pronunciation"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def per_call(name, func, inputs, results):
+    """ Time func over all inputs """
+    seconds, _ = timed(lambda: [func(expr) for expr in inputs])
+    results[name] = {"seconds": seconds, "calls": len(inputs),
+                     "per_call_us": seconds / max(len(inputs), 1) * 1e6}
+
+
+def make_notes(keys, count, rng):
+    """ Synthetic notes with single words, separated words and sentences """
+    model = {"name": "Japanese", "id": 1, "mod": 0,
+             "flds": [{"name": "Expression"}, {"name": "Pronunciation"}]}
+    notes = {}
+    for nid in range(count):
+        kind = nid % 3
+        if kind == 0:
+            expr = rng.choice(keys)
+        elif kind == 1:
+            expr = u"・".join(rng.sample(keys, 3))
+        else:
+            expr = u"<b>%s</b>は%sです" % (rng.choice(keys), rng.choice(keys))
+        notes[nid] = Note(model, {"Expression": expr, "Pronunciation": u""})
+    return notes
+
+
+def run(args):
+    config = json.load(io.open(os.path.join(dir_path, "config.json"), encoding="utf-8"))
+    config["useMecab"] = bool(args.mecab)
+    mw = install_stubs(config)
+    rng = random.Random(args.seed)
+    results = {}
+
+    workdir = tempfile.mkdtemp(prefix="nhk_benchmark_")
+    try:
+        shutil.copy(os.path.join(dir_path, "nhk_pronunciation.py"), workdir)
+        shutil.copy(os.path.join(dir_path, "nhk_pronunciation_core.py"), workdir)
+        shutil.copy(os.path.join(dir_path, "config.json"), workdir)
+        sys.path.insert(0, workdir)
+        shutil.copy(args.accdb, os.path.join(workdir, "ACCDB_unicode.csv"))
+        addon_path = os.path.join(workdir, "nhk_pronunciation.py")
+
+        # Startup: the first import builds everything, later ones load the
+        # index. Loading happens in the background, so the import itself and
+        # the time until the database is ready are timed separately.
+        for name in ("startup_rebuild", "startup_cached"):
+            import_seconds, addon = timed(import_addon, addon_path)
+            ready_seconds, _ = timed(addon.ensure_database)
+            results[name] = {"import_seconds": import_seconds, "seconds": import_seconds + ready_seconds}
+
+        # The lookup engine and its state live in the core module
+        m = addon.core
+        if args.mecab:
+            m.setup_mecab(args.mecab)
+
+        results["build_database"] = {"seconds": timed(m.build_database, None, 1)[0]}
+        m.thedict, m.reading_dict = {}, {}
+        results["read_derivative"] = {"seconds": timed(m.read_derivative)[0]}
+        m.prepare_database()
+
+        keys = [key for key in m.thedict if key]
+        sample = rng.sample(keys, min(args.lookups, len(keys)))
+        per_call("lookup_direct", m.getPronunciations, sample, results)
+        # Render cache is warm now
+        per_call("lookup_direct_warm", m.getPronunciations, sample, results)
+
+        split = [u"・".join(rng.sample(keys, 3)) for _ in range(args.lookups)]
+        per_call("lookup_split", m.getPronunciations, split, results)
+
+        sentences = [u"%sは%sです" % (rng.choice(keys), rng.choice(keys)) for _ in range(args.lookups)]
+        if args.mecab:
+            per_call("lookup_mecab", m.getPronunciations, sentences, results)
+        else:
+            results["lookup_mecab"] = None
+            per_call("lookup_dictionary_split", m.getPronunciations, sentences, results)
+
+        m.formatted_cache.clear()
+        notes = make_notes(keys, args.notes, rng)
+        mw.col = Collection(notes)
+        seconds, _ = timed(addon.regeneratePronunciations, list(notes))
+        results["regenerate"] = {"seconds": seconds, "notes": len(notes),
+                                 "per_note_us": seconds / max(len(notes), 1) * 1e6}
+    finally:
+        sys.path.remove(workdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "accdb": os.path.abspath(args.accdb),
+        "mecab": bool(args.mecab),
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--accdb", default=os.path.join(dir_path, "ACCDB_unicode.csv"),
+                        help="original NHK database to build from")
+    parser.add_argument("--mecab", default=None,
+                        help="support folder of the Japanese add-on, to also time Mecab lookups")
+    parser.add_argument("--lookups", type=int, default=5000, help="number of lookups per benchmark")
+    parser.add_argument("--notes", type=int, default=10000, help="number of notes to regenerate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.accdb):
+        parser.error("Could not locate %s" % args.accdb)
+
+    report = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output:
+        with io.open(args.output, "w", encoding="utf-8") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
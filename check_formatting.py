@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Golden check of the pitch accent formatting: every row of the original NHK
+database is formatted both by AccentPattern and by the string concatenation
+format_entry that the add-on used before, and the results must be the same.
+The accent numbers and L/H patterns of render() are checked against the ones
+read back from that html.
+
+Usage: python check_formatting.py [--accdb ACCDB_unicode.csv] [--show N]
+
+Exits with status 1 if anything differs. Needs Python 3.
+"""
+
+import argparse
+import io
+import os
+import re
+import sys
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, dir_path)
+
+import nhk_pronunciation_core as core
+
+
+# ************************************************
+#       Formatting of the original add-on        *
+# ************************************************
+def baseline_entry(line):
+    """ Parse a row of the original database like the original build_database """
+    line = line.strip()
+    substrs = re.findall(r'(\{.*?,.*?\})', line)
+    substrs.extend(re.findall(r'(\(.*?,.*?\))', line))
+    for s in substrs:
+        line = line.replace(s, s.replace(',', ';'))
+    return core.AccentEntry._make(line.split(","))
+
+
+def baseline_format_entry(e):
+    """ Format an entry from the data in the original database to something that uses html """
+    txt = e.midashigo1
+    strlen = len(txt)
+    acclen = len(e.ac)
+    accent = "0"*(strlen-acclen) + e.ac
+
+    # Get the nasal positions
+    nasal = []
+    if e.nasalsoundpos:
+        positions = e.nasalsoundpos.split('0')
+        for p in positions:
+            if p:
+                nasal.append(int(p))
+            if not p:
+                # e.g. "20" would result in ['2', '']
+                nasal[-1] = nasal[-1] * 10
+
+    # Get the no pronounce positions
+    nopron = []
+    if e.nopronouncepos:
+        positions = e.nopronouncepos.split('0')
+        for p in positions:
+            if p:
+                nopron.append(int(p))
+            if not p:
+                # e.g. "20" would result in ['2', '']
+                nopron[-1] = nopron[-1] * 10
+
+    outstr = ""
+    overline = False
+
+    for i in range(strlen):
+        a = int(accent[i])
+        # Start or end overline when necessary
+        if not overline and a > 0:
+            outstr = outstr + '<span class="overline">'
+            overline = True
+        if overline and a == 0:
+            outstr = outstr + '</span>'
+            overline = False
+
+        if (i+1) in nopron:
+            outstr = outstr + '<span class="nopron">'
+
+        # Add the character stuff
+        outstr = outstr + txt[i]
+
+        # Add the pronunciation stuff
+        if (i+1) in nopron:
+            outstr = outstr + "</span>"
+        if (i+1) in nasal:
+            outstr = outstr + '<span class="nasal">&#176;</span>'
+
+        # If we go down in pitch, add the downfall
+        if a == 2:
+            outstr = outstr + '</span>&#42780;'
+            overline = False
+
+    # Close the overline if it's still open
+    if overline:
+        outstr = outstr + "</span>"
+
+    return outstr
+
+
+# ************************************************
+#        Pitch read back from the html           *
+# ************************************************
+# Kana that are part of the same mora as the kana before them
+small_kana = u'ァィゥェォャュョヮぁぃぅぇぉゃゅょゎ'
+html_token_regex = re.compile(r'<span class="(overline|nopron)">|</span>|<span class="nasal">&#176;</span>|&#42780;|.')
+
+
+def html_pitch(html):
+    """
+    Read the accent back from html made by baseline_format_entry: the
+    characters under an overline are high, and the downfall mark follows the
+    character after which the pitch drops. Returns (pattern, accent number),
+    with morae made of a kana and the small kana after it.
+    """
+    spans = []
+    morae = []
+    drop = 0
+    for match in html_token_regex.finditer(html):
+        token = match.group(0)
+        if match.group(1):
+            spans.append(match.group(1))
+        elif token == '</span>':
+            spans.pop()
+        elif token == '&#42780;':
+            drop = drop or len(morae)
+        elif not token.startswith('<'):
+            if morae and token in small_kana:
+                continue
+            morae.append("H" if "overline" in spans else "L")
+    return "".join(morae), drop
+
+
+# ************************************************
+#                   Checks                       *
+# ************************************************
+def check(path, show):
+    counts = {"rows": 0, "html": 0, "number": 0, "pattern": 0}
+
+    def mismatch(kind, line, expected, found):
+        counts[kind] += 1
+        if counts[kind] <= show:
+            print("%s differs for %s\n  expected: %s\n  found:    %s" % (kind, line.strip(), expected, found))
+
+    with io.open(path, encoding="utf-8") as f:
+        for line in f:
+            counts["rows"] += 1
+            expected = baseline_format_entry(baseline_entry(line))
+            pattern = core.AccentPattern.from_entry(core.parse_row(line)[1])
+
+            if pattern.html() != expected:
+                mismatch("html", line, expected, pattern.html())
+
+            expected_pattern, expected_number = html_pitch(expected)
+            if pattern.render("number") != str(expected_number):
+                mismatch("number", line, expected_number, pattern.render("number"))
+            if pattern.render("pattern") != expected_pattern:
+                mismatch("pattern", line, expected_pattern, pattern.render("pattern"))
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--accdb", default=os.path.join(dir_path, "ACCDB_unicode.csv"),
+                        help="original NHK database to check")
+    parser.add_argument("--show", type=int, default=10, help="number of differences of each kind to print")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.accdb):
+        parser.error("Could not locate %s" % args.accdb)
+
+    counts = check(args.accdb, args.show)
+    print("%(rows)d rows: %(html)d html, %(number)d accent number and %(pattern)d pattern differences" % counts)
+    sys.exit(1 if counts["html"] or counts["number"] or counts["pattern"] else 0)
+
+
+if __name__ == "__main__":
+    main()
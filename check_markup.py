@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Check of the markup stripping: strip_html_markup (one regex and unescaping)
+is compared with the HTMLParser based version the add-on used before, on a
+list of tricky cases and on generated note fields. The old parser was never
+closed, so it lost what it kept back at the end of its input: the text
+after a bare "&", or a bare "<". Those are the only results that are allowed
+to differ.
+
+Usage: python check_markup.py [--fields N] [--seed N] [--show N]
+
+Exits with status 1 if anything else differs. Needs Python 3.
+"""
+
+import argparse
+import os
+import random
+import sys
+from html.parser import HTMLParser
+
+dir_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, dir_path)
+
+import nhk_pronunciation_core as core
+
+
+# ************************************************
+#       Markup stripping of the original add-on  *
+# ************************************************
+class HTMLTextExtractor(HTMLParser):
+        def __init__(self):
+            if issubclass(self.__class__, object):
+                super(HTMLTextExtractor, self).__init__()
+            else:
+                HTMLParser.__init__(self)
+            self.result = []
+
+        def handle_data(self, d):
+            self.result.append(d)
+
+        def get_text(self):
+            return ''.join(self.result)
+
+
+def baseline_strip_html_markup(html, recursive=False):
+    """
+    The original strip_html_markup. Also returns what the parser kept back
+    at the end of its input, and so lost, in every round.
+    """
+    held = []
+    old_text = None
+    new_text = html
+    while new_text != old_text:
+        old_text = new_text
+        s = HTMLTextExtractor()
+        s.feed(new_text)
+        new_text = s.get_text()
+        held.append(s.rawdata)
+
+        if not recursive:
+            break
+
+    return new_text, held
+
+
+# ************************************************
+#                   Cases                        *
+# ************************************************
+# (html, recursive, result of strip_html_markup, result of the original
+# version if it differs)
+cases = [
+    # Quoted ">" inside attributes
+    (u'<a title="x>y">日本</a>', False, u'日本', None),
+    (u"<span data-x='a>b' class=\"c\">語</span>", False, u'語', None),
+    (u'<img alt="<b>">橋', False, u'橋', None),
+    # A tag cut off at the end of the field
+    (u'日本<span class="x', False, u'日本', None),
+    (u'日本<span title="a>b', False, u'日本', None),
+    (u'日本</', False, u'日本', None),
+    # Comments, doctypes and processing instructions
+    (u'日<!-- <b>x</b> -->本', False, u'日本', None),
+    (u'<!DOCTYPE html>日本', False, u'日本', None),
+    (u'<?xml version="1.0"?>日本', False, u'日本', None),
+    # Not markup
+    (u'a < b > c', False, u'a < b > c', None),
+    (u'<3 日本', False, u'<3 日本', None),
+    # Entities
+    (u'日本&nbsp;語&#12354;', False, u'日本\xa0語あ', None),
+    (u'&lt;b&gt;日本&lt;/b&gt;', False, u'<b>日本</b>', None),
+    # Recursive mode strips escaped markup too
+    (u'&lt;b&gt;日本&lt;/b&gt;', True, u'日本', None),
+    (u'<div>&amp;lt;i&amp;gt;語&amp;lt;/i&amp;gt;</div>', True, u'語', None),
+    (u'<b>日本</b>', True, u'日本', None),
+    # The intended differences: the original lost the text after a bare "&",
+    # and a bare "<" at the end
+    (u'&amp;amp;', True, u'&', u''),
+    (u'&amp;amp;', False, u'&amp;', None),
+    (u'日本 AT&T', False, u'日本 AT&T', u''),
+    (u'<b>日本</b>AT&T', False, u'日本AT&T', u'日本'),
+    (u'日本 <', False, u'日本 <', u'日本 '),
+]
+
+
+# ************************************************
+#               Generated fields                 *
+# ************************************************
+pieces = [
+    u'日本', u'語', u'はし', u'ハシ', u'・', u'、', u' ', u'/', u'abc',
+    u'<b>', u'</b>', u'<br>', u'<br />', u'<div class="x">', u'</div>',
+    u'<span style="color: red;">', u'</span>', u'<a title="x>y">', u'</a>',
+    u'<!-- c -->', u'<!DOCTYPE html>', u'&nbsp;', u'&amp;', u'&lt;b&gt;',
+    u'&lt;/b&gt;', u'&#12354;', u'&', u'<', u'>', u'<3', u'"', u"'",
+]
+
+
+def generate_fields(count, rng):
+    for _ in range(count):
+        yield u''.join(rng.choice(pieces) for _ in range(rng.randint(1, 12)))
+
+
+# ************************************************
+#                   Checks                       *
+# ************************************************
+def check(args):
+    failures = []
+
+    for html, recursive, expected, expected_old in cases:
+        found = core.strip_html_markup(html, recursive)
+        old, held = baseline_strip_html_markup(html, recursive)
+        if expected_old is None:
+            expected_old = expected
+        if found != expected or old != expected_old:
+            failures.append((html, recursive, expected, found, expected_old, old))
+
+    lost_count = 0
+    rng = random.Random(args.seed)
+    for html in generate_fields(args.fields, rng):
+        for recursive in (False, True):
+            found = core.strip_html_markup(html, recursive)
+            old, held = baseline_strip_html_markup(html, recursive)
+            # Apart from a cut-off tag, which both drop, what the original
+            # kept back must be all that is missing
+            lost = [core.strip_html_markup(text) for text in held]
+            if recursive and any(lost):
+                # Lost text changed the input of the next rounds
+                lost_count += 1
+                continue
+            expected = old + lost[-1]
+            if found != expected:
+                failures.append((html, recursive, expected, found, old, old))
+            elif lost[-1]:
+                lost_count += 1
+
+    for html, recursive, expected, found, expected_old, old in failures[:args.show]:
+        print("%r (recursive=%s)\n  expected: %r, found: %r\n  original: %r, found: %r"
+              % (html, recursive, expected, found, expected_old, old))
+    print("%d cases and %d generated fields: %d differences, %d results where the original lost text at the end"
+          % (len(cases), args.fields, len(failures), lost_count))
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--fields", type=int, default=50000, help="number of generated fields")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--show", type=int, default=10, help="number of differences to print")
+    args = parser.parse_args()
+
+    sys.exit(0 if check(args) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,50 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple, OrderedDict
-
 import io
-import re
+import json
 import os
-import platform
-import subprocess
 import sys
+import threading
 import time
 
 if sys.version_info.major == 3:
     from PyQt5.QtWidgets import *
-    import pickle
-    from html.parser import HTMLParser
+    import queue
 else:
-    import cPickle as pickle
-    from HTMLParser import HTMLParser
+    import Queue as queue
 
 from aqt import mw
 from aqt.qt import *
-from aqt.utils import isMac, isWin, showInfo, showText
+from aqt.utils import showInfo, showText
+
+# The lookup engine lives in a module of its own, which does not need Anki.
+# Anki 2.1 loads the add-on as a package, Anki 2.0 as a top-level module.
+try:
+    from . import nhk_pronunciation_core as core
+except (ImportError, ValueError):
+    import nhk_pronunciation_core as core
+
+# Re-export the lookup API, for other add-ons that use it
+getPronunciations = core.getPronunciations
+getPronunciationsByReading = core.getPronunciationsByReading
+getFormattedPronunciations = core.getFormattedPronunciations
+getPronunciationsBatch = core.getPronunciationsBatch
+getFormattedPronunciationsBatch = core.getFormattedPronunciationsBatch
+format_pronunciations = core.format_pronunciations
+lookup_stats_report = core.lookup_stats_report
+ensure_database = core.ensure_database
+stats = core.stats
 
 # ************************************************
 #                Global Variables                *
 # ************************************************
-
-# Paths to the database files and this particular file
-dir_path = os.path.dirname(os.path.normpath(__file__))
-thisfile = os.path.join(dir_path, "nhk_pronunciation.py")
-derivative_database = os.path.join(dir_path, "nhk_pronunciation.csv")
-derivative_pickle = os.path.join(dir_path, "nhk_pronunciation.pickle")
-accent_database = os.path.join(dir_path, "ACCDB_unicode.csv")
-
-# "Class" declaration
-AccentEntry = namedtuple('AccentEntry', ['NID','ID','WAVname','K_FLD','ACT','midashigo','nhk','kanjiexpr','NHKexpr','numberchars','nopronouncepos','nasalsoundpos','majiri','kaisi','KWAV','midashigo1','akusentosuu','bunshou','ac'])
-
-# The main dict used to store all entries
-thedict = {}
-
+dir_path = core.dir_path
 
 if sys.version_info.major == 2:
-    import json
     config = json.load(io.open(os.path.join(dir_path, 'nhk_pronunciation_config.json'), 'r', encoding="utf-8"))
 else:
     config = mw.addonManager.getConfig(__name__)
+core.configure(config)
 
 # Check if Mecab is available and/or if the user wants it to be used
 if config['useMecab']:
@@ -69,353 +69,13 @@ if lookup_mecab and not mecab_exists:
     showInfo("NHK-Pronunciation: Mecab use requested, but Japanese add-on with Mecab not found.")
     lookup_mecab = False
 
-
-# ************************************************
-#                  Helper functions              *
-# ************************************************
-def katakana_to_hiragana(to_translate):
-    hiragana = u'がぎぐげござじずぜぞだぢづでどばびぶべぼぱぴぷぺぽ' \
-               u'あいうえおかきくけこさしすせそたちつてと' \
-               u'なにぬねのはひふへほまみむめもやゆよらりるれろ' \
-               u'わをんぁぃぅぇぉゃゅょっ'
-    katakana = u'ガギグゲゴザジズゼゾダヂヅデドバビブベボパピプペポ' \
-               u'アイウエオカキクケコサシスセソタチツテト' \
-               u'ナニヌネノハヒフヘホマミムメモヤユヨラリルレロ' \
-               u'ワヲンァィゥェォャュョッ'
-    katakana = [ord(char) for char in katakana]
-    translate_table = dict(zip(katakana, hiragana))
-    return to_translate.translate(translate_table)
-
-
-class HTMLTextExtractor(HTMLParser):
-        def __init__(self):
-            if issubclass(self.__class__, object):
-                super(HTMLTextExtractor, self).__init__()
-            else:
-                HTMLParser.__init__(self)
-            self.result = []
-
-        def handle_data(self, d):
-            self.result.append(d)
-
-        def get_text(self):
-            return ''.join(self.result)
-
-
-def strip_html_markup(html, recursive=False):
-    """
-    Strip html markup. If the html contains escaped html markup itself, one
-    can use the recursive option to also strip this.
-    """
-    old_text = None
-    new_text = html
-    while new_text != old_text:
-        old_text = new_text
-        s = HTMLTextExtractor()
-        s.feed(new_text)
-        new_text = s.get_text()
-
-        if not recursive:
-            break
-
-    return new_text
-
-
-# Ref: https://stackoverflow.com/questions/15033196/using-javascript-to-check-whether-a-string-contains-japanese-characters-includi/15034560#15034560
-non_jap_regex = re.compile(u'[^\u3000-\u303f\u3040-\u309f\u30a0-\u30ff\uff66-\uff9f\u4e00-\u9fff\u3400-\u4dbf]+', re.U)
-jp_sep_regex = re.compile(u'[・、※【】「」〒◎×〃゜『』《》〜〽。〄〇〈〉〓〔〕〖〗〘 〙〚〛〝 〞〟〠〡〢〣〥〦〧〨〫  〬  〭  〮〯〶〷〸〹〺〻〼〾〿]', re.U)
-
-
-def split_separators(expr):
-    """
-    Split text by common separators (like / or ・) into separate words that can
-    be looked up.
-    """
-    expr = strip_html_markup(expr).strip()
-
-    # Replace all typical separators with a space
-    expr = re.sub(non_jap_regex, ' ', expr)  # Remove non-Japanese characters
-    expr = re.sub(jp_sep_regex, ' ', expr)  # Remove Japanese punctuation
-    expr_all = expr.split(' ')
-
-    return expr_all
-
-
-# ******************************************************************
-#                               Mecab                              *
-#  Copied from Japanese add-on by Damien Elmes with minor changes. *
-# ******************************************************************
-
-class MecabController():
-
-    def __init__(self, base_path):
-        self.mecab = None
-        self.base_path = os.path.normpath(base_path)
-
-        if sys.platform == "win32":
-            self._si = subprocess.STARTUPINFO()
-            try:
-                self._si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            except:
-                self._si.dwFlags |= subprocess._subprocess.STARTF_USESHOWWINDOW
-        else:
-            self._si = None
-
-    @staticmethod
-    def mungeForPlatform(popen):
-        if isWin:
-            # popen = [os.path.normpath(x) for x in popen]
-            popen[0] += ".exe"
-        elif not isMac:
-            popen[0] += ".lin"
-        return popen
-
-    def setup(self):
-        mecabArgs = ['--node-format=%f[6] ', '--eos-format=\n',
-                     '--unk-format=%m[] ']
-
-        self.mecabCmd = self.mungeForPlatform(
-            [os.path.join(self.base_path, "mecab")] + mecabArgs + [
-                '-d', self.base_path, '-r', os.path.join(self.base_path, "mecabrc")])
-
-        os.environ['DYLD_LIBRARY_PATH'] = self.base_path
-        os.environ['LD_LIBRARY_PATH'] = self.base_path
-        if not isWin:
-            os.chmod(self.mecabCmd[0], 0o755)
-
-    def ensureOpen(self):
-        if not self.mecab:
-            self.setup()
-            try:
-                self.mecab = subprocess.Popen(
-                    self.mecabCmd, bufsize=-1, stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                    startupinfo=self._si)
-            except OSError as e:
-                raise Exception(str(e) + ": Please ensure your Linux system has 64 bit binary support.")
-
-    @staticmethod
-    def _escapeText(text):
-        # strip characters that trip up kakasi/mecab
-        text = text.replace("\n", " ")
-        text = text.replace(u'\uff5e', "~")
-        text = re.sub("<br( /)?>", "---newline---", text)
-        text = strip_html_markup(text, True)
-        text = text.replace("---newline---", "<br>")
-        return text
-
-    def reading(self, expr):
-        self.ensureOpen()
-        expr = self._escapeText(expr)
-        try:
-            self.mecab.stdin.write(expr.encode("utf-8", "ignore") + b'\n')
-            self.mecab.stdin.flush()
-            expr = self.mecab.stdout.readline().rstrip(b'\r\n').decode('utf-8')
-        except UnicodeDecodeError as e:
-           raise Exception(str(e) + ": Please ensure you have updated to the most recent Japanese Support add-on.")
-
-        return expr
-
-
 if lookup_mecab:
-    mecab_reader = MecabController(mecab_base_path)
-
-
-# ************************************************
-#           Database generation functions        *
-# ************************************************
-def format_entry(e):
-    """ Format an entry from the data in the original database to something that uses html """
-    txt = e.midashigo1
-    strlen = len(txt)
-    acclen = len(e.ac)
-    accent = "0"*(strlen-acclen) + e.ac
-
-    # Get the nasal positions
-    nasal = []
-    if e.nasalsoundpos:
-        positions = e.nasalsoundpos.split('0')
-        for p in positions:
-            if p:
-                nasal.append(int(p))
-            if not p:
-                # e.g. "20" would result in ['2', '']
-                nasal[-1] = nasal[-1] * 10
-
-    # Get the no pronounce positions
-    nopron = []
-    if e.nopronouncepos:
-        positions = e.nopronouncepos.split('0')
-        for p in positions:
-            if p:
-                nopron.append(int(p))
-            if not p:
-                # e.g. "20" would result in ['2', '']
-                nopron[-1] = nopron[-1] * 10
-
-    outstr = ""
-    overline = False
-
-    for i in range(strlen):
-        a = int(accent[i])
-        # Start or end overline when necessary
-        if not overline and a > 0:
-            outstr = outstr + '<span class="overline">'
-            overline = True
-        if overline and a == 0:
-            outstr = outstr + '</span>'
-            overline = False
-
-        if (i+1) in nopron:
-            outstr = outstr + '<span class="nopron">'
-
-        # Add the character stuff
-        outstr = outstr + txt[i]
-
-        # Add the pronunciation stuff
-        if (i+1) in nopron:
-            outstr = outstr + "</span>"
-        if (i+1) in nasal:
-            outstr = outstr + '<span class="nasal">&#176;</span>'
-
-        # If we go down in pitch, add the downfall
-        if a == 2:
-            outstr = outstr + '</span>&#42780;'
-            overline = False
-
-    # Close the overline if it's still open
-    if overline:
-        outstr = outstr + "</span>"
-
-    return outstr
-
-
-def build_database():
-    """ Build the derived database from the original database """
-    tempdict = {}
-    entries = []
-
-    f = io.open(accent_database, 'r', encoding="utf-8")
-    for line in f:
-        line = line.strip()
-        substrs = re.findall(r'(\{.*?,.*?\})', line)
-        substrs.extend(re.findall(r'(\(.*?,.*?\))', line))
-        for s in substrs:
-            line = line.replace(s, s.replace(',', ';'))
-        entries.append(AccentEntry._make(line.split(",")))
-    f.close()
-
-    for e in entries:
-        textentry = format_entry(e)
-
-        # A tuple holding both the spelling in katakana, and the katakana with pitch/accent markup
-        kanapron = (e.midashigo, textentry)
-
-        # Add expressions for both
-        for key in [e.nhk, e.kanjiexpr]:
-            if key in tempdict:
-                if kanapron not in tempdict[key]:
-                    tempdict[key].append(kanapron)
-            else:
-                tempdict[key] = [kanapron]
-
-    o = io.open(derivative_database, 'w', encoding="utf-8")
-
-    for key in tempdict.keys():
-        for kana, pron in tempdict[key]:
-            o.write("%s\t%s\t%s\n" % (key, kana, pron))
-
-    o.close()
-
-
-def read_derivative():
-    """ Read the derivative file to memory """
-    f = io.open(derivative_database, 'r', encoding="utf-8")
-
-    for line in f:
-        key, kana, pron = line.strip().split("\t")
-        kanapron = (kana, pron)
-        if key in thedict:
-            if kanapron not in thedict[key]:
-                thedict[key].append(kanapron)
-        else:
-            thedict[key] = [kanapron]
-
-    f.close()
+    core.setup_mecab(mecab_base_path)
 
 
 # ************************************************
 #              Lookup Functions                  *
 # ************************************************
-def inline_style(txt):
-    """ Map style classes to their inline version """
-
-    for k, v in config["styles"].items():
-        txt = txt.replace(k, v)
-
-    return txt
-
-
-def getPronunciations(expr, sanitize=True, recurse=True):
-    """
-    Search pronuncations for a particular expression
-
-    Returns a dictionary mapping the expression (or sub-expressions contained
-    in the expression) to a list of html-styled pronunciations.
-    """
-
-    # Sanitize input
-    if sanitize:
-        expr = strip_html_markup(expr)
-        expr = expr.strip()
-
-    ret = OrderedDict()
-    if expr in thedict:
-        styled_prons = []
-
-        for kana, pron in thedict[expr]:
-            inlinepron = inline_style(pron)
-
-            if config["pronunciationHiragana"]:
-                inlinepron = katakana_to_hiragana(inlinepron)
-
-            if inlinepron not in styled_prons:
-                styled_prons.append(inlinepron)
-        ret[expr] = styled_prons
-    elif recurse:
-        # Try to split the expression in various ways, and check if any of those results
-        split_expr = split_separators(expr)
-
-        if len(split_expr) > 1:
-            for expr in split_expr:
-                ret.update(getPronunciations(expr, sanitize))
-
-        # Only if lookups were not succesful, we try splitting with Mecab
-        if not ret and lookup_mecab:
-            for sub_expr in mecab_reader.reading(expr).split():
-                # Avoid infinite recursion by saying that we should not try
-                # Mecab again if we do not find any matches for this sub-
-                # expression.
-                ret.update(getPronunciations(sub_expr, sanitize, False))
-
-    return ret
-
-
-def getFormattedPronunciations(expr, sep_single=" *** ", sep_multi="<br/>\n", expr_sep=None, sanitize=True):
-    prons = getPronunciations(expr, sanitize)
-
-    single_merge = OrderedDict()
-    for k, v in prons.items():
-        single_merge[k] = sep_single.join(v)
-
-    if expr_sep:
-        txt = sep_multi.join([u"{}{}{}".format(k, expr_sep, v) for k, v in single_merge.items()])
-    else:
-        txt = sep_multi.join(single_merge.values())
-
-    return txt
-
-
 def lookupPronunciation(expr):
     """ Show the pronunciation when the user does a manual lookup """
     txt = getFormattedPronunciations(expr, "<br/>\n", "<br/><br/>\n", ":<br/>\n")
@@ -473,18 +133,118 @@ def createMenu():
     a.triggered.connect(onLookupPronunciation)
 
 
+def createStatsMenu():
+    """ Add menu entries to show and export the lookup statistics """
+    ml = mw.form.menuLookup
+
+    a = QAction(mw)
+    a.setText("...pronunciation statistics")
+    ml.addAction(a)
+    a.triggered.connect(showLookupStats)
+
+    a = QAction(mw)
+    a.setText("...export pronunciation statistics")
+    ml.addAction(a)
+    a.triggered.connect(exportLookupStats)
+
+
+def format_lookup_stats(report):
+    """ The statistics as a plain text table """
+    lines = ["Statistics of the last %d seconds" % report["seconds"], ""]
+
+    lookups = dict((k[len("lookup."):], v) for k, v in report["counters"].items() if k.startswith("lookup."))
+    total = sum(lookups.values())
+    lines.append("Lookups: %d" % total)
+    for name, n in sorted(lookups.items()):
+        lines.append("  %-18s %8d  %5.1f%%" % (name, n, 100.0 * n / total))
+    lines.append("")
+
+    lines.append("%-25s %8s %10s %10s %10s %10s" % ("Function", "Calls", "Total ms", "Mean us", "p50 us", "p99 us"))
+    for name, timing in sorted(report["timings"].items()):
+        lines.append("%-25s %8d %10.1f %10.1f %10d %10d" % (
+            name, timing["calls"], timing["seconds"] * 1e3, timing["seconds"] * 1e6 / timing["calls"],
+            core.LookupStats.percentile(timing["histogram"], 0.5), core.LookupStats.percentile(timing["histogram"], 0.99)))
+    lines.append("")
+
+    for name, cache in sorted(report["caches"].items()):
+        lines.append("Cache %s: %s" % (name, ", ".join("%s %d" % item for item in sorted(cache.items()))))
+
+    return "\n".join(lines)
+
+
+def showLookupStats():
+    if not stats.enabled:
+        showInfo("Enable \"instrumentation\" in the add-on config to collect statistics.")
+        return
+    showText(format_lookup_stats(lookup_stats_report()))
+
+
+def exportLookupStats():
+    path = QFileDialog.getSaveFileName(mw, "Export pronunciation statistics", "nhk_pronunciation_stats.json", "JSON (*.json)")
+    # PyQt5 returns (path, filter), PyQt4 just the path
+    if isinstance(path, tuple):
+        path = path[0]
+    if not path:
+        return
+
+    f = io.open(path, 'w', encoding="utf-8")
+    f.write(u"%s" % json.dumps(lookup_stats_report(), indent=1, sort_keys=True))
+    f.close()
+
+
 def setupBrowserMenu(browser):
-    """ Add menu entry to browser window """
+    """ Add menu entries to browser window """
     a = QAction("Bulk-add Pronunciations", browser)
     a.triggered.connect(lambda: onRegenerate(browser))
     browser.form.menuEdit.addSeparator()
     browser.form.menuEdit.addAction(a)
 
+    a = QAction("Bulk-add Pronunciations (Dry Run)...", browser)
+    a.triggered.connect(lambda: onRegenerateDryRun(browser))
+    browser.form.menuEdit.addAction(a)
+
+    a = QAction("Apply Pronunciation Diff...", browser)
+    a.triggered.connect(lambda: onApplyDiff(browser))
+    browser.form.menuEdit.addAction(a)
+
 
 def onRegenerate(browser):
     regeneratePronunciations(browser.selectedNotes())
 
 
+def onRegenerateDryRun(browser):
+    path = QFileDialog.getSaveFileName(browser, "Save pronunciation diff", "nhk_pronunciation_diff.jsonl", "JSON lines (*.jsonl)")
+    # PyQt5 returns (path, filter), PyQt4 just the path
+    if isinstance(path, tuple):
+        path = path[0]
+    if not path:
+        return
+
+    counts = write_regenerate_diff(browser.selectedNotes(), path)
+    showInfo("Pronunciation diff written to %s:\n%d changed, %d unchanged, %d skipped" %
+             (path, counts["changed"], counts["unchanged"], counts["skipped"]))
+
+
+def onApplyDiff(browser):
+    path = QFileDialog.getOpenFileName(browser, "Apply pronunciation diff", "", "JSON lines (*.jsonl)")
+    if isinstance(path, tuple):
+        path = path[0]
+    if not path:
+        return
+
+    counts = apply_regenerate_diff(path)
+    showInfo("%d notes updated, %d changed since the diff was made, %d no longer exist" %
+             (counts["applied"], counts["conflict"], counts["missing"]))
+
+
+def on_config_updated(new_config):
+    """ Apply a config edited in the add-on manager, and drop everything derived from the old one """
+    global config
+    config = new_config
+    core.configure(config)
+    note_type_cache.clear()
+
+
 def get_src_dst_fields(fields):
     """ Set source and destination fieldnames """
     src = None
@@ -506,38 +266,55 @@ def get_src_dst_fields(fields):
 
     return src, srcIdx, dst, dstIdx
 
-def add_pronunciation_once(fields, model, data, n):
-    """ When possible, temporarily set the pronunciation to a field """
 
-    # Check if this is a supported note type. If it is not, return.
+# Note type id -> (modification time, resolved fields) for note_type_fields
+note_type_cache = {}
+
+
+def note_type_fields(model):
+    """
+    Return (src, srcIdx, dst, dstIdx) for a note type, or None if it is not
+    a supported note type or lacks a source or destination field. The result
+    is cached until the note type is modified or the config is updated.
+    """
+    cached = note_type_cache.get(model['id'])
+    if cached is not None and cached[0] == model['mod']:
+        return cached[1]
+
+    ret = None
+    # Check if this is a supported note type.
     # If no note type has been specified, we always continue the lookup proces.
-    if config["noteTypes"] and not any(nt.lower() in model['name'].lower() for nt in config["noteTypes"]):
-        return fields
+    if not config["noteTypes"] or any(nt.lower() in model['name'].lower() for nt in config["noteTypes"]):
+        src, srcIdx, dst, dstIdx = get_src_dst_fields([f['name'] for f in model['flds']])
+        if src is not None and dst is not None:
+            ret = (src, srcIdx, dst, dstIdx)
 
-    src, srcIdx, dst, dstIdx = get_src_dst_fields(fields)
+    note_type_cache[model['id']] = (model['mod'], ret)
+    return ret
 
-    if src is None or dst is None:
+@stats.timed("mungeFields")
+def add_pronunciation_once(fields, model, data, n):
+    """ When possible, temporarily set the pronunciation to a field """
+    resolved = note_type_fields(model)
+    if resolved is None:
         return fields
 
+    src, srcIdx, dst, dstIdx = resolved
+
     # Only add the pronunciation if there's not already one in the pronunciation field
     if not fields[dst]:
         fields[dst] = getFormattedPronunciations(fields[src])
 
     return fields
 
+@stats.timed("editFocusLost")
 def add_pronunciation_focusLost(flag, n, fidx):
-    # Check if this is a supported note type. If it is not, return.
-    # If no note type has been specified, we always continue the lookup proces.
-    if config["noteTypes"] and not any(nt.lower() in n.model()['name'].lower() for nt in config["noteTypes"]):
+    resolved = note_type_fields(n.model())
+    if resolved is None:
         return flag
 
     from aqt import mw
-    fields = mw.col.models.fieldNames(n.model())
-
-    src, srcIdx, dst, dstIdx = get_src_dst_fields(fields)
-
-    if not src or not dst:
-        return flag
+    src, srcIdx, dst, dstIdx = resolved
 
     # dst field already filled?
     if n[dst]:
@@ -560,63 +337,245 @@ def add_pronunciation_focusLost(flag, n, fidx):
     return True
 
 
-def regeneratePronunciations(nids):
-    mw.checkpoint("Bulk-add Pronunciations")
-    mw.progress.start()
+def load_regenerate_chunk(nids):
+    """
+    Load notes, and return (todo, skipped): (note, dst, srcTxt) for those that
+    should get a pronunciation, and (note, reason) for the others.
+    """
+    todo = []
+    skipped = []
     for nid in nids:
         note = mw.col.getNote(nid)
 
-        # Check if this is a supported note type. If it is not, skip.
-        # If no note type has been specified, we always continue the lookup proces.
-        if config["noteTypes"] and not any(nt.lower() in note.model()['name'].lower() for nt in config["noteTypes"]):
+        resolved = note_type_fields(note.model())
+        if resolved is None:
+            skipped.append((note, "unsupported note type"))
             continue
 
-        src, srcIdx, dst, dstIdx = get_src_dst_fields(note)
-
-        if src is None or dst is None:
-            continue
+        src, srcIdx, dst, dstIdx = resolved
 
         if note[dst] and not config["regenerateReadings"]:
             # already contains data, skip
+            skipped.append((note, "already has a pronunciation"))
             continue
 
         srcTxt = mw.col.media.strip(note[src])
         if not srcTxt.strip():
+            skipped.append((note, "empty source field"))
             continue
 
-        note[dst] = getFormattedPronunciations(srcTxt)
+        todo.append((note, dst, srcTxt))
+
+    return todo, skipped
+
+
+class LookupWorker(threading.Thread):
+    """
+    Thread that runs getFormattedPronunciationsBatch on the lists of texts
+    put in self.jobs, and puts the results (or the exception raised) in
+    self.results. Put None in self.jobs to stop it.
+    """
+
+    def __init__(self):
+        super(LookupWorker, self).__init__()
+        self.daemon = True
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+
+    def run(self):
+        while True:
+            texts = self.jobs.get()
+            if texts is None:
+                break
+            try:
+                self.results.put(getFormattedPronunciationsBatch(texts))
+            except Exception as e:
+                self.results.put(e)
+
+    def result(self):
+        """ Wait for the next result, while keeping the interface responsive """
+        while True:
+            try:
+                ret = self.results.get(timeout=0.05)
+            except queue.Empty:
+                mw.app.processEvents()
+                continue
 
-        note.flush()
-    mw.progress.finish()
-    mw.reset()
+            if isinstance(ret, Exception):
+                raise ret
+            return ret
+
+
+def progress_cancelled():
+    # Only recent Anki versions let the user cancel a progress dialog
+    want_cancel = getattr(mw.progress, "want_cancel", None)
+    return bool(want_cancel and want_cancel())
+
+
+def regenerate_chunks(nids, chunksize):
+    """
+    Generator over the notes with the given ids, in chunks of chunksize
+    notes. Yields (chunk, results, skipped) per chunk, where results are
+    (note, dst, pronunciation) for the notes that should get one, and
+    skipped is as returned by load_regenerate_chunk. Notes are loaded on the
+    calling thread, while the pronunciations of the previous chunk are
+    looked up by a LookupWorker, and only two chunks are in memory at a time.
+    """
+    worker = LookupWorker()
+    worker.start()
+
+    try:
+        chunks = [nids[i:i + chunksize] for i in range(0, len(nids), chunksize)]
+        todo, skipped = load_regenerate_chunk(chunks[0]) if chunks else ([], [])
+
+        for i, chunk in enumerate(chunks):
+            worker.jobs.put([srcTxt for note, dst, srcTxt in todo])
+
+            # Load the next chunk while the worker looks up this one
+            next_chunk = load_regenerate_chunk(chunks[i + 1]) if i + 1 < len(chunks) else ([], [])
+
+            results = [(note, dst, pron) for (note, dst, srcTxt), pron in zip(todo, worker.result())]
+            yield chunk, results, skipped
+
+            todo, skipped = next_chunk
+    finally:
+        worker.jobs.put(None)
+
+
+def update_regenerate_progress(title, started, done, total, updated):
+    remaining = (time.time() - started) / done * (total - done)
+    mw.progress.update(label="%s: %d/%d notes done, %d updated, %d:%02d left" %
+                             (title, done, total, updated, remaining // 60, remaining % 60),
+                       value=done)
+
+
+@stats.timed("regeneratePronunciations")
+def regeneratePronunciations(nids, chunksize=500):
+    """ Add pronunciations to the notes with the given ids """
+    mw.checkpoint("Bulk-add Pronunciations")
+    mw.progress.start(max=len(nids), immediate=True)
+
+    started = time.time()
+    done = 0
+    updated = 0
+
+    try:
+        for chunk, results, skipped in regenerate_chunks(nids, chunksize):
+            for note, dst, pron in results:
+                note[dst] = pron
+                note.flush()
+
+            done += len(chunk)
+            updated += len(results)
+            update_regenerate_progress("Bulk-add Pronunciations", started, done, len(nids), updated)
+
+            if progress_cancelled():
+                break
+    finally:
+        mw.progress.finish()
+        mw.reset()
+
+
+def regenerate_diff(nids, chunksize=500):
+    """
+    Generator of what regeneratePronunciations would do to the notes with the
+    given ids, without changing them. Yields one dict per note, with its
+    "nid" and "status": "changed" (with the "field" and its "old" and "new"
+    value), "unchanged", or "skipped" (with the "reason").
+    """
+    for chunk, results, skipped in regenerate_chunks(nids, chunksize):
+        for note, reason in skipped:
+            yield {"nid": note.id, "status": "skipped", "reason": reason}
+
+        for note, dst, pron in results:
+            if note[dst] == pron:
+                yield {"nid": note.id, "status": "unchanged"}
+            else:
+                yield {"nid": note.id, "status": "changed", "field": dst, "old": note[dst], "new": pron}
+
+
+def write_regenerate_diff(nids, path, chunksize=500):
+    """
+    Write the regenerate_diff of the notes with the given ids to path, one
+    JSON object per line, and return the number of notes of each status.
+    """
+    counts = {"changed": 0, "unchanged": 0, "skipped": 0}
+    mw.progress.start(max=len(nids), immediate=True)
+    started = time.time()
+
+    f = io.open(path, 'w', encoding="utf-8")
+    try:
+        for record in regenerate_diff(nids, chunksize):
+            f.write(u"%s\n" % json.dumps(record, ensure_ascii=False, sort_keys=True))
+            counts[record["status"]] += 1
+
+            done = sum(counts.values())
+            if done % chunksize == 0 or done == len(nids):
+                update_regenerate_progress("Bulk-add Pronunciations (Dry Run)", started, done, len(nids), counts["changed"])
+                if progress_cancelled():
+                    break
+    finally:
+        f.close()
+        mw.progress.finish()
+
+    return counts
+
+
+def apply_regenerate_diff(path):
+    """
+    Apply the changes of a diff written by write_regenerate_diff, without
+    looking anything up again. Notes whose field no longer holds the old
+    value are left alone. Returns the number of notes that were "applied",
+    that had a "conflict", or that are "missing".
+    """
+    counts = {"applied": 0, "conflict": 0, "missing": 0}
+    mw.checkpoint("Apply Pronunciation Diff")
+    mw.progress.start(immediate=True)
+
+    f = io.open(path, encoding="utf-8")
+    try:
+        for line in f:
+            record = json.loads(line)
+            if record["status"] != "changed":
+                continue
+
+            try:
+                note = mw.col.getNote(record["nid"])
+            except Exception:
+                counts["missing"] += 1
+                continue
+
+            if record["field"] not in note or note[record["field"]] != record["old"]:
+                counts["conflict"] += 1
+                continue
+
+            note[record["field"]] = record["new"]
+            note.flush()
+            counts["applied"] += 1
+            if counts["applied"] % 500 == 0:
+                mw.progress.update(label="Apply Pronunciation Diff: %d notes updated" % counts["applied"])
+    finally:
+        f.close()
+        mw.progress.finish()
+        mw.reset()
+
+    return counts
 
 
 # ************************************************
 #                   Main                         *
 # ************************************************
 
-# First check that either the original database, or the derivative text file are present:
-if not os.path.exists(derivative_database) and not os.path.exists(accent_database):
-    raise IOError("Could not locate the original base or the derivative database!")
-
-# Generate the derivative database if it does not exist yet
-if (os.path.exists(accent_database) and not os.path.exists(derivative_database)) or (os.path.exists(accent_database) and os.stat(thisfile).st_mtime > os.stat(derivative_database).st_mtime):
-    build_database()
-
-# If a pickle exists of the derivative file, use that. Otherwise, read from the derivative file and generate a pickle.
-if  (os.path.exists(derivative_pickle) and
-    os.stat(derivative_pickle).st_mtime > os.stat(derivative_database).st_mtime):
-    f = io.open(derivative_pickle, 'rb')
-    thedict = pickle.load(f)
-    f.close()
-else:
-    read_derivative()
-    f = io.open(derivative_pickle, 'wb')
-    pickle.dump(thedict, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
+# Make sure the derivative database and its index are up to date, and load
+# them. This happens in the background; lookups wait for it if necessary.
+core.start_loading_database()
 
 # Create the manual look-up menu entry
 createMenu()
+createStatsMenu()
+
+if sys.version_info.major == 3:
+    mw.addonManager.setConfigUpdatedAction(__name__, on_config_updated)
 
 from anki.hooks import addHook
 
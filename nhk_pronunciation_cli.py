@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Add NHK pronunciations to the rows of a TSV, CSV or JSON lines file, outside
+of Anki. Rows are read, looked up and written in chunks, so memory use does
+not depend on the size of the input, and the output is in input order.
+
+Usage: python nhk_pronunciation_cli.py [--workers N] [--mecab DIR] input.tsv > output.tsv
+
+Reads standard input when the input is "-". Needs Python 3.
+"""
+
+import argparse
+import collections
+import csv
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import nhk_pronunciation_core as core
+
+FORMATS = ("tsv", "csv", "jsonl")
+
+
+# ************************************************
+#                   Lookups                      *
+# ************************************************
+def init_worker(config, mecab_path):
+    """ Prepare the lookup engine in this process """
+    core.configure(config)
+    if mecab_path:
+        core.setup_mecab(mecab_path)
+    core.ensure_database()
+
+
+def lookup_chunk(texts):
+    return core.getFormattedPronunciationsBatch(texts)
+
+
+def lookup_chunks(chunks, workers, config, mecab_path):
+    """
+    Generator of the pronunciations of each list of texts in chunks, in
+    order. With more than one worker the lookups are done by a process pool,
+    which gets at most two chunks per worker ahead of the results that have
+    been consumed, so the input is streamed instead of read all at once.
+    """
+    if workers <= 1:
+        init_worker(config, mecab_path)
+        for texts in chunks:
+            yield lookup_chunk(texts)
+        return
+
+    pool = multiprocessing.Pool(workers, init_worker, (config, mecab_path))
+    try:
+        pending = collections.deque()
+        for texts in chunks:
+            pending.append(pool.apply_async(lookup_chunk, (texts,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+# ************************************************
+#                 Input / output                 *
+# ************************************************
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def read_rows(f, fmt):
+    if fmt == "jsonl":
+        return (json.loads(line) for line in f if line.strip())
+    return csv.reader(f, delimiter="\t" if fmt == "tsv" else ",")
+
+
+def row_writer(f, fmt):
+    if fmt == "jsonl":
+        return lambda row: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return csv.writer(f, delimiter="\t" if fmt == "tsv" else ",", lineterminator="\n").writerow
+
+
+def find_column(rows, args):
+    """
+    The key or index of the column with the expressions, and the header row
+    if there is one, which is read from rows. Raises ValueError if there is
+    no such column.
+    """
+    if args.format == "jsonl":
+        return args.column, None
+
+    header = None
+    if args.header:
+        header = next(rows, None)
+        if header is None:
+            # Empty input, there is nothing to look up
+            return 0, None
+        if args.column in header:
+            return header.index(args.column), header
+    if not args.column.isdigit():
+        raise ValueError("There is no column %s in %s" % (args.column, args.input))
+    return int(args.column), header
+
+
+def annotate(rows, outfile, args, config, column, header=None):
+    """
+    Add a pronunciation column to every row and write them to outfile, after
+    the header if there is one.
+    """
+    write = row_writer(outfile, args.format)
+    if header is not None:
+        write(header + [args.output_column])
+
+    def text(row):
+        if args.format == "jsonl":
+            return row.get(column) or u""
+        return row[column] if column < len(row) else u""
+
+    chunks = chunked(rows, args.chunksize)
+    # The rows of each chunk wait in memory until their lookups are done
+    waiting = collections.deque()
+
+    def texts():
+        for chunk in chunks:
+            waiting.append(chunk)
+            yield [text(row) for row in chunk]
+
+    for prons in lookup_chunks(texts(), args.workers, config, args.mecab):
+        for row, pron in zip(waiting.popleft(), prons):
+            if args.format == "jsonl":
+                row[args.output_column] = pron
+            else:
+                # Keep every row on a single line, the <br/> still separates the expressions
+                row.append(pron.replace("\n", ""))
+            write(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("input", help="file to annotate, or - for standard input")
+    parser.add_argument("--output", default=None, help="write to this file instead of standard output")
+    parser.add_argument("--format", choices=FORMATS, default=None,
+                        help="format of the input and output (default: from the input's extension)")
+    parser.add_argument("--column", default=None,
+                        help="column with the expressions: a name for JSON lines and files with --header, "
+                             "otherwise a 0-based index (default: Expression / 0)")
+    parser.add_argument("--header", action="store_true", help="the first row of the TSV or CSV file is a header")
+    parser.add_argument("--output-column", default="Pronunciation",
+                        help="name of the added column, for JSON lines and files with --header")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of lookup processes (default: number of CPUs)")
+    parser.add_argument("--build-workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes used to build the database when needed (default: number of CPUs)")
+    parser.add_argument("--chunksize", type=int, default=1000, help="number of rows sent to a worker at once")
+    parser.add_argument("--config", default=None, help="config file (default: the add-on's config.json)")
+    parser.add_argument("--mecab", default=None,
+                        help="support folder of the Japanese add-on, to look up what is not in the dictionary with Mecab")
+    args = parser.parse_args()
+
+    if args.format is None:
+        ext = os.path.splitext(args.input)[1].lstrip(".").lower()
+        args.format = {"txt": "tsv", "json": "jsonl"}.get(ext, ext)
+        if args.format not in FORMATS:
+            parser.error("Cannot tell the format of %s, use --format" % args.input)
+    if args.column is None:
+        args.column = "Expression" if args.format == "jsonl" or args.header else "0"
+
+    config = core.read_config(args.config)
+    config["useMecab"] = bool(args.mecab)
+
+    # Build the database once, before the workers load it
+    core.configure(config)
+    core.ensure_database(args.build_workers)
+
+    if args.input == "-":
+        infile = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    else:
+        infile = io.open(args.input, encoding="utf-8", newline="")
+    if args.output:
+        outfile = io.open(args.output, "w", encoding="utf-8", newline="")
+    else:
+        outfile = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", newline="")
+
+    try:
+        rows = read_rows(infile, args.format)
+        try:
+            column, header = find_column(rows, args)
+        except ValueError as e:
+            parser.error(str(e))
+        annotate(rows, outfile, args, config, column, header)
+    finally:
+        infile.close()
+        outfile.flush()
+        if args.output:
+            outfile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1943 @@
+# -*- coding: utf-8 -*-
+"""
+The pronunciation lookup engine of the NHK pronunciation add-on, without any
+dependency on Anki, so it can also be used by scripts and other programs.
+
+Typical use:
+
+    import nhk_pronunciation_core as core
+    core.configure(core.read_config())
+    core.ensure_database()
+    core.getFormattedPronunciations(u"日本語")
+"""
+
+from collections import namedtuple, OrderedDict
+
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import re
+import os
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+import unicodedata
+
+if sys.version_info.major == 3:
+    from html import unescape as unescape_html
+    import queue
+else:
+    from HTMLParser import HTMLParser
+    unescape_html = HTMLParser().unescape
+    import Queue as queue
+
+isWin = sys.platform.startswith("win32")
+isMac = sys.platform.startswith("darwin")
+
+# ************************************************
+#                Global Variables                *
+# ************************************************
+
+# Paths to the database files
+dir_path = os.path.dirname(os.path.normpath(__file__))
+derivative_database = os.path.join(dir_path, "nhk_pronunciation.csv")
+derivative_index = os.path.join(dir_path, "nhk_pronunciation.idx")
+reading_index = os.path.join(dir_path, "nhk_pronunciation.reading.idx")
+fuzzy_index = os.path.join(dir_path, "nhk_pronunciation.fuzzy.idx")
+accent_database = os.path.join(dir_path, "ACCDB_unicode.csv")
+build_manifest = os.path.join(dir_path, "nhk_pronunciation.manifest.json")
+row_cache = os.path.join(dir_path, "nhk_pronunciation.rows")
+mecab_cache_path = os.path.join(dir_path, "nhk_pronunciation.mecab.sqlite")
+
+# Bump this whenever format_entry or AccentPattern change their output, so
+# existing installs regenerate their derivative database.
+FORMATTER_VERSION = 2
+
+# Bump this whenever normalize_key changes, so the fuzzy index is rebuilt
+NORMALIZER_VERSION = 1
+
+# Config options that influence the generated files (none so far)
+BUILD_CONFIG_KEYS = []
+
+# "Class" declaration
+AccentEntry = namedtuple('AccentEntry', ['NID','ID','WAVname','K_FLD','ACT','midashigo','nhk','kanjiexpr','NHKexpr','numberchars','nopronouncepos','nasalsoundpos','majiri','kaisi','KWAV','midashigo1','akusentosuu','bunshou','ac'])
+
+# The main dict used to store all entries. Once the database is loaded this is
+# replaced by a (read-only) PronunciationIndex, which behaves like a dict.
+thedict = {}
+
+# Secondary dict (and later PronunciationIndex) mapping readings in hiragana
+# to the (expression, pronunciation) pairs with that reading
+reading_dict = {}
+
+# Dict (and later PronunciationIndex) mapping the normalized keys of spelling
+# variants (see normalize_key) to the entries of all their spellings
+fuzzy_dict = {}
+
+
+def read_json(path):
+    with io.open(path, 'r', encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_config(path=None):
+    """
+    Read the config shipped next to this module, with the options of the
+    config file at path, if given, on top of it. Under Anki 2.0 this module
+    shares the add-ons folder with other add-ons, where a config.json may
+    belong to any of them, so nhk_pronunciation_config.json is tried first.
+    """
+    default_path = os.path.join(dir_path, 'nhk_pronunciation_config.json')
+    if not os.path.exists(default_path):
+        default_path = os.path.join(dir_path, 'config.json')
+
+    config = read_json(default_path)
+    if path is not None:
+        config.update(read_json(path))
+    return config
+
+
+# The current config. Programs using this module can replace it with configure.
+config = read_config()
+
+# Whether Mecab is used for what is not in the dictionary, see setup_mecab
+lookup_mecab = False
+mecab_reader = None
+
+# LookupClient that getPronunciations forwards to, if the "lookupServer"
+# config option is set (see configure)
+lookup_client = None
+
+
+# ************************************************
+#                  Helper functions              *
+# ************************************************
+def make_katakana_table():
+    hiragana = u'がぎぐげござじずぜぞだぢづでどばびぶべぼぱぴぷぺぽ' \
+               u'あいうえおかきくけこさしすせそたちつてと' \
+               u'なにぬねのはひふへほまみむめもやゆよらりるれろ' \
+               u'わをんぁぃぅぇぉゃゅょっ'
+    katakana = u'ガギグゲゴザジズゼゾダヂヅデドバビブベボパピプペポ' \
+               u'アイウエオカキクケコサシスセソタチツテト' \
+               u'ナニヌネノハヒフヘホマミムメモヤユヨラリルレロ' \
+               u'ワヲンァィゥェォャュョッ'
+    katakana = [ord(char) for char in katakana]
+    return dict(zip(katakana, hiragana))
+
+
+katakana_table = make_katakana_table()
+
+
+def katakana_to_hiragana(to_translate):
+    return to_translate.translate(katakana_table)
+
+
+if sys.version_info.major == 3:
+    intern_string = sys.intern
+else:
+    def intern_string(txt):
+        # Python 2 can only intern byte strings
+        return txt
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded cache that evicts the least recently used item.
+    Items older than ttl seconds are treated as missing (a ttl of 0 or None
+    disables this), and a maxsize of 0 disables the cache altogether.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stamp = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self.ttl and time.time() - stamp > self.ttl:
+                self.misses += 1
+                return default
+
+            # Re-insert to mark it as most recently used
+            self._data[key] = (value, stamp)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LookupStats(object):
+    """
+    Optional instrumentation of the lookup code: counters, and the number of
+    calls, total time and a latency histogram of every timed function. The
+    histogram buckets are powers of two in microseconds.
+    """
+    nbuckets = 25
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started = time.time()
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_timing(self, name, seconds):
+        us = int(seconds * 1e6)
+        bucket = min(us.bit_length(), self.nbuckets - 1)
+        with self._lock:
+            if name not in self.timings:
+                self.timings[name] = {"calls": 0, "seconds": 0.0, "histogram": [0] * self.nbuckets}
+            timing = self.timings[name]
+            timing["calls"] += 1
+            timing["seconds"] += seconds
+            timing["histogram"][bucket] += 1
+
+    def timed(self, name):
+        """ Decorator that records the time spent in a function, if instrumentation is enabled """
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add_timing(name, time.time() - start)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def percentile(histogram, fraction):
+        """ Upper bound in microseconds of the bucket that holds the given fraction of the calls """
+        limit = sum(histogram) * fraction
+        seen = 0
+        for bucket, n in enumerate(histogram):
+            seen += n
+            if n and seen >= limit:
+                return 1 << bucket
+        return 0
+
+    def snapshot(self):
+        with self._lock:
+            return {"enabled": self.enabled,
+                    "seconds": time.time() - self.started,
+                    "counters": dict(self.counters),
+                    "timings": json.loads(json.dumps(self.timings))}
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.timings.clear()
+
+
+stats = LookupStats(config["instrumentation"])
+
+
+# Comments, doctypes and other declarations, processing instructions, end
+# tags, start tags (whose quoted attribute values may contain ">") and a tag
+# that is cut off at the end of the text, possibly inside a quoted value
+tag_body = r'(?:[^>=]|=\s*"[^"]*"|=\s*\'[^\']*\'|=(?!\s*["\']))*'
+markup_regex = re.compile(r'<!--.*?-->|<[!?/][^>]*>|<[a-zA-Z]%s>|<[!?/][^>]*$|'
+                          r'<[a-zA-Z]%s(?:=\s*"[^"]*|=\s*\'[^\']*)?$' % (tag_body, tag_body), re.S)
+
+
+@stats.timed("strip_html_markup")
+def strip_html_markup(html, recursive=False):
+    """
+    Strip html markup. If the html contains escaped html markup itself, one
+    can use the recursive option to also strip this.
+    """
+    old_text = None
+    new_text = html
+    while new_text != old_text:
+        old_text = new_text
+        new_text = markup_regex.sub('', new_text)
+        if '&' in new_text:
+            new_text = unescape_html(new_text)
+
+        if not recursive:
+            break
+
+    return new_text
+
+
+# Ref: https://stackoverflow.com/questions/15033196/using-javascript-to-check-whether-a-string-contains-japanese-characters-includi/15034560#15034560
+non_jap_regex = re.compile(u'[^\u3000-\u303f\u3040-\u309f\u30a0-\u30ff\uff66-\uff9f\u4e00-\u9fff\u3400-\u4dbf]+', re.U)
+jp_sep_regex = re.compile(u'[・、※【】「」〒◎×〃゜『』《》〜〽。〄〇〈〉〓〔〕〖〗〘 〙〚〛〝 〞〟〠〡〢〣〥〦〧〨〫  〬  〭  〮〯〶〷〸〹〺〻〼〾〿]', re.U)
+# Both of the above: a run of non-Japanese characters, or a single Japanese separator
+separator_regex = re.compile(u'%s|%s' % (non_jap_regex.pattern, jp_sep_regex.pattern), re.U)
+
+
+def split_separators(expr):
+    """
+    Split text by common separators (like / or ・) into separate words that can
+    be looked up.
+    """
+    expr = strip_html_markup(expr).strip()
+
+    # Split on non-Japanese characters and Japanese punctuation
+    return separator_regex.split(expr)
+
+
+# ******************************************************************
+#                               Mecab                              *
+#  Copied from Japanese add-on by Damien Elmes with minor changes. *
+# ******************************************************************
+
+class MecabError(Exception):
+    """ Mecab crashed, or its output did not line up with its input """
+
+
+class MecabTimeout(MecabError):
+    """ Mecab did not answer a line in time, after answering the first answered lines """
+
+    def __init__(self, answered):
+        MecabError.__init__(self, "Mecab did not answer line %d in time." % (answered + 1))
+        self.answered = answered
+
+
+class MecabController():
+
+    def __init__(self, base_path, timeout=None):
+        self.mecab = None
+        self.base_path = os.path.normpath(base_path)
+        # Seconds to wait for a line of output before Mecab is considered hung
+        self.timeout = timeout
+        self._output = None
+        self._lock = threading.Lock()
+
+        if sys.platform == "win32":
+            self._si = subprocess.STARTUPINFO()
+            try:
+                self._si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            except:
+                self._si.dwFlags |= subprocess._subprocess.STARTF_USESHOWWINDOW
+        else:
+            self._si = None
+
+    @staticmethod
+    def mungeForPlatform(popen):
+        if isWin:
+            # popen = [os.path.normpath(x) for x in popen]
+            popen[0] += ".exe"
+        elif not isMac:
+            popen[0] += ".lin"
+        return popen
+
+    def setup(self):
+        mecabArgs = ['--node-format=%f[6] ', '--eos-format=\n',
+                     '--unk-format=%m[] ']
+
+        self.mecabCmd = self.mungeForPlatform(
+            [os.path.join(self.base_path, "mecab")] + mecabArgs + [
+                '-d', self.base_path, '-r', os.path.join(self.base_path, "mecabrc")])
+
+        os.environ['DYLD_LIBRARY_PATH'] = self.base_path
+        os.environ['LD_LIBRARY_PATH'] = self.base_path
+        if not isWin:
+            os.chmod(self.mecabCmd[0], 0o755)
+
+    def ensureOpen(self):
+        # (Re)start Mecab if it was never started, or if it exited
+        if not self.mecab or self.mecab.poll() is not None:
+            self.setup()
+            try:
+                self.mecab = subprocess.Popen(
+                    self.mecabCmd, bufsize=-1, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    startupinfo=self._si)
+            except OSError as e:
+                raise Exception(str(e) + ": Please ensure your Linux system has 64 bit binary support.")
+
+            # Lines are read by a separate thread, so waiting for them can time out
+            self._output = queue.Queue()
+            reader = threading.Thread(target=self._read_output, args=(self.mecab.stdout, self._output))
+            reader.daemon = True
+            reader.start()
+
+    @staticmethod
+    def _read_output(stdout, output):
+        for line in iter(stdout.readline, b''):
+            output.put(line)
+        # End of file: Mecab exited
+        output.put(None)
+
+    def close(self):
+        if self.mecab:
+            try:
+                self.mecab.kill()
+            except OSError:
+                pass
+            self.mecab = None
+
+    @staticmethod
+    def _escapeText(text):
+        # strip characters that trip up kakasi/mecab
+        text = text.replace("\n", " ")
+        text = text.replace(u'\uff5e', "~")
+        text = re.sub("<br( /)?>", "---newline---", text)
+        text = strip_html_markup(text, True)
+        text = text.replace("---newline---", "<br>")
+        # Unescaped entities like &#10; can add line breaks, which would make
+        # Mecab answer with more lines than it was sent
+        text = text.replace("\r", " ").replace("\n", " ")
+        return text
+
+    def identity(self):
+        """ Identifies the Mecab binary, dictionary and options, to detect stale cached readings """
+        self.setup()
+        files = []
+        for name in sorted(os.listdir(self.base_path)):
+            path = os.path.join(self.base_path, name)
+            if name.startswith("mecab") or name.endswith((".dic", ".bin", ".def")):
+                st = os.stat(path)
+                files.append([name, st.st_size, st.st_mtime])
+        return hashlib.sha1(json.dumps([self.mecabCmd[1:4], files]).encode("utf-8")).hexdigest()
+
+    # Sent after every batch. Mecab echoes it as an unknown word, which shows
+    # that the lines before it were all answered, and nothing else.
+    sentinel = u"zqxnhkeobzqx"
+
+    def _communicate(self, lines):
+        """
+        Send escaped lines to Mecab and read back one result per line. Raises
+        MecabTimeout when a line is not answered within the timeout, and
+        MecabError when Mecab exits or its output does not end with the
+        sentinel right after the last result. Mecab is then killed, and
+        restarted on the next call.
+        """
+        self.ensureOpen()
+        data = b''.join(line.encode("utf-8", "ignore") + b'\n' for line in lines + [self.sentinel])
+        mecab = self.mecab
+
+        # The batch is written by a separate thread while the results are read
+        # back, so it cannot deadlock on full pipes.
+        def write():
+            try:
+                mecab.stdin.write(data)
+                mecab.stdin.flush()
+            except (IOError, OSError):
+                # Mecab died or was killed, which the reader notices
+                pass
+
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+
+        ret = []
+        try:
+            while True:
+                try:
+                    line = self._output.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise MecabTimeout(len(ret))
+
+                if line is None:
+                    raise MecabError("Mecab exited unexpectedly.")
+
+                line = line.rstrip(b'\r\n').decode('utf-8')
+                if line.replace(u" ", u"") == self.sentinel:
+                    if len(ret) != len(lines):
+                        raise MecabError("Mecab answered %d lines instead of %d." % (len(ret), len(lines)))
+                    break
+                if len(ret) == len(lines):
+                    raise MecabError("Mecab answered more lines than it was sent.")
+                ret.append(line)
+        except Exception:
+            # Garbage output or a crash: never reuse this process
+            self.close()
+            raise
+        finally:
+            writer.join(self.timeout)
+
+        return ret
+
+    def _isolate(self, lines):
+        """
+        Like _communicate, but a line that makes Mecab hang, crash or answer
+        garbage only loses its own reading, which is None. The line Mecab hung
+        on is skipped and the others are sent again; a batch that failed
+        otherwise is split in halves until the lines that cause it are found.
+        """
+        try:
+            return self._communicate(lines)
+        except MecabTimeout as e:
+            i = e.answered
+            if i < len(lines):
+                rest = self._isolate(lines[:i] + lines[i + 1:])
+                return rest[:i] + [None] + rest[i:]
+            # Every line was answered but the sentinel was not, so the
+            # answers cannot be trusted: handled like any other error below
+        except MecabError:
+            pass
+
+        # If Mecab does not even answer an empty batch, trying every line
+        # would only restart it over and over
+        self._communicate([])
+        if len(lines) == 1:
+            return [None]
+        half = len(lines) // 2
+        return self._isolate(lines[:half]) + self._isolate(lines[half:])
+
+    def readings(self, exprs):
+        """
+        Readings of a list of expressions, in the same order. If Mecab hangs,
+        crashes or its output does not line up with the expressions, it is
+        restarted and the expressions are sent again, except for the ones that
+        caused it: their reading is None.
+        """
+        return self.escaped_readings([self._escapeText(expr) for expr in exprs])
+
+    def escaped_readings(self, lines):
+        """ Same as readings, for expressions that were already escaped with _escapeText """
+        if not lines:
+            return []
+
+        with self._lock:
+            try:
+                ret = self._isolate(list(lines))
+            except UnicodeDecodeError as e:
+                raise Exception(str(e) + ": Please ensure you have updated to the most recent Japanese Support add-on.")
+
+        # Readings out of step with their lines would end up in the cache
+        if len(ret) != len(lines):
+            raise MecabError("Mecab returned %d readings for %d lines." % (len(ret), len(lines)))
+        return ret
+
+    def reading(self, expr):
+        return self.readings([expr])[0] or u""
+
+
+class MecabCache(object):
+    """
+    Readings of earlier Mecab calls, stored in an SQLite database so they
+    survive restarts. Entries are keyed on the escaped input text. All of
+    them are dropped when the identity of Mecab (see
+    MecabController.identity) changes, and the oldest ones are evicted when
+    there are more than maxsize. The database is opened on first use.
+    """
+
+    def __init__(self, path, identity, maxsize):
+        self.path = path
+        self.identity = identity
+        self.maxsize = maxsize
+        self._db = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("create table if not exists meta (key text primary key, value text)")
+        db.execute("create table if not exists readings (expr text primary key, reading text)")
+
+        identity = self.identity()
+        row = db.execute("select value from meta where key = 'identity'").fetchone()
+        if not row or row[0] != identity:
+            db.execute("delete from readings")
+            db.execute("insert or replace into meta values ('identity', ?)", (identity,))
+            db.commit()
+
+        self._count = db.execute("select count(*) from readings").fetchone()[0]
+        self._db = db
+        return db
+
+    def get_many(self, exprs):
+        """ Return a dict with the cached readings of exprs """
+        exprs = list(set(exprs))
+        ret = {}
+        with self._lock:
+            db = self._connect()
+            # Stay below SQLite's limit on the number of parameters
+            for i in range(0, len(exprs), 500):
+                chunk = exprs[i:i + 500]
+                ret.update(db.execute("select expr, reading from readings where expr in (%s)" %
+                                      ",".join("?" * len(chunk)), chunk))
+        return ret
+
+    def put_many(self, items):
+        """ Store (escaped expression, reading) pairs """
+        with self._lock:
+            db = self._connect()
+            items = list(items)
+            db.executemany("insert or replace into readings values (?, ?)", items)
+            # Only misses are stored, so this overestimates at most
+            self._count += len(items)
+
+            # Evict the oldest entries, with some slack so this does not happen on every put
+            if self._count > self.maxsize:
+                db.execute("delete from readings where rowid in "
+                           "(select rowid from readings order by rowid limit ?)",
+                           (self._count - self.maxsize * 9 // 10,))
+                self._count = db.execute("select count(*) from readings").fetchone()[0]
+            db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class MecabPool(object):
+    """
+    A few Mecab processes that requests are dispatched to round-robin. Large
+    batches are split over all processes. Readings come from the (optional)
+    MecabCache when possible.
+    """
+
+    def __init__(self, base_path, size=1, timeout=None):
+        self.workers = [MecabController(base_path, timeout) for _ in range(max(size, 1))]
+        # Optional MecabCache with the readings of earlier sessions
+        self.cache = None
+        self._next = 0
+
+    def identity(self):
+        return self.workers[0].identity()
+
+    def _next_worker(self):
+        self._next = (self._next + 1) % len(self.workers)
+        return self.workers[self._next]
+
+    def _dispatch(self, exprs):
+        """ Split escaped exprs over the workers and return their readings in order """
+        nchunks = min(len(self.workers), len(exprs) // 100 + 1)
+        if nchunks == 1:
+            return self._next_worker().escaped_readings(exprs)
+
+        size = -(-len(exprs) // nchunks)
+        chunks = [exprs[i:i + size] for i in range(0, len(exprs), size)]
+        results = [None] * len(chunks)
+        errors = []
+
+        def run(i, worker):
+            try:
+                results[i] = worker.escaped_readings(chunks[i])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(i, self._next_worker())) for i in range(len(chunks))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+        return [reading for chunk in results for reading in chunk]
+
+    @stats.timed("mecab")
+    def readings(self, exprs):
+        """ Readings of a list of expressions, in the same order """
+        escaped = [MecabController._escapeText(expr) for expr in exprs]
+        known = self.cache.get_many(escaped) if self.cache else {}
+
+        todo = []
+        for expr in escaped:
+            if expr not in known:
+                known[expr] = None
+                todo.append(expr)
+
+        if todo:
+            found = self._dispatch(todo)
+            known.update(zip(todo, found))
+            if self.cache:
+                # Lines that timed out are not worth remembering
+                self.cache.put_many((expr, reading) for expr, reading in zip(todo, found) if reading is not None)
+
+        return [known[expr] or u"" for expr in escaped]
+
+    def reading(self, expr):
+        return self.readings([expr])[0]
+
+    def prefetch(self, exprs):
+        """
+        Look up the readings of many expressions in one batch, and return
+        them as a dict by expression. Lookups get it as their own argument
+        instead of through the pool, so concurrent batches do not share it.
+        """
+        todo = list(OrderedDict.fromkeys(exprs))
+        return dict(zip(todo, self.readings(todo)))
+
+
+def setup_mecab(base_path):
+    """ Look up what is not in the dictionary with the Mecab found in base_path """
+    global lookup_mecab, mecab_reader
+    mecab_reader = MecabPool(base_path, config["mecabProcesses"], config["mecabTimeout"] or None)
+    if config["mecabCacheSize"] > 0:
+        mecab_reader.cache = MecabCache(mecab_cache_path, mecab_reader.identity, config["mecabCacheSize"])
+    lookup_mecab = True
+
+
+# ************************************************
+#           Database generation functions        *
+# ************************************************
+def parse_positions(positions):
+    """
+    Bitmask of character positions as stored in the original database, where
+    "2" is the 2nd character and "102" the 1st and 2nd; bit 0 is the 1st.
+    """
+    found = []
+    if positions:
+        for p in positions.split('0'):
+            if p:
+                found.append(int(p))
+            if not p:
+                # e.g. "20" would result in ['2', '']
+                found[-1] = found[-1] * 10
+
+    mask = 0
+    for p in found:
+        mask |= 1 << (p - 1)
+    return mask
+
+
+# Kana that are part of the same mora as the kana before them
+small_kana = u'ァィゥェォャュョヮぁぃぅぇぉゃゅょゎ'
+
+
+class AccentPattern(object):
+    """
+    Compact pitch accent of an entry: the kana as shown, the accent digit of
+    every character (without leading zeros) and bitmasks of the characters
+    that are not pronounced or nasal. The html is rendered by html() when it
+    is needed. Strings are interned, as the same ones occur many times.
+    """
+    __slots__ = ('text', 'accent', 'nopron', 'nasal')
+
+    def __init__(self, text, accent, nopron=0, nasal=0):
+        self.text = intern_string(text)
+        self.accent = intern_string(accent)
+        self.nopron = nopron
+        self.nasal = nasal
+
+    @classmethod
+    def from_entry(cls, e):
+        return cls(e.midashigo1, e.ac, parse_positions(e.nopronouncepos), parse_positions(e.nasalsoundpos))
+
+    @classmethod
+    def from_fields(cls, fields):
+        """ Inverse of fields() """
+        text, accent, nopron, nasal = fields
+        return cls(text, accent, int(nopron), int(nasal))
+
+    def fields(self):
+        """ The pattern as strings, for the derivative database """
+        return [self.text, self.accent, str(self.nopron), str(self.nasal)]
+
+    def _key(self):
+        return (self.text, self.accent, self.nopron, self.nasal)
+
+    def __eq__(self, other):
+        return isinstance(other, AccentPattern) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __getstate__(self):
+        return self._key()
+
+    def __setstate__(self, state):
+        self.text, self.accent, self.nopron, self.nasal = state
+
+    def accents(self):
+        """ The accent digit of every character """
+        return self.accent.rjust(len(self.text), "0")
+
+    def html(self):
+        """ The kana with the pitch accent as html """
+        parts = []
+        overline = False
+        nopron = self.nopron
+        nasal = self.nasal
+
+        for i, (char, a) in enumerate(zip(self.text, self.accents())):
+            # Start or end overline when necessary
+            if a != "0":
+                if not overline:
+                    parts.append('<span class="overline">')
+                    overline = True
+            elif overline:
+                parts.append('</span>')
+                overline = False
+
+            # Add the character, with the pronunciation stuff
+            if nopron >> i & 1:
+                parts.append('<span class="nopron">%s</span>' % char)
+            else:
+                parts.append(char)
+            if nasal >> i & 1:
+                parts.append('<span class="nasal">&#176;</span>')
+
+            # If we go down in pitch, add the downfall
+            if a == "2":
+                parts.append('</span>&#42780;')
+                overline = False
+
+        # Close the overline if it's still open
+        if overline:
+            parts.append("</span>")
+
+        return "".join(parts)
+
+    def morae(self):
+        """ Split the text into morae, as (kana, accent digit) pairs """
+        ret = []
+        for char, a in zip(self.text, self.accents()):
+            if ret and char in small_kana:
+                ret[-1] = (ret[-1][0] + char, ret[-1][1] + a)
+            else:
+                ret.append((char, a))
+        return ret
+
+    def pitch_pattern(self):
+        """ List of (mora, high) pairs, e.g. [(u'コ', False), (u'ハ', True), (u'レ', True)] """
+        return [(mora, digits[0] != "0") for mora, digits in self.morae()]
+
+    def accent_number(self):
+        """ The mora after which the pitch drops, or 0 if it does not (heiban) """
+        for i, (mora, digits) in enumerate(self.morae()):
+            if "2" in digits:
+                return i + 1
+        return 0
+
+    def render(self, output_format="html"):
+        """
+        The pitch accent in one of the output formats: "html", "number" (the
+        accent number) or "pattern" (L/H per mora, e.g. "LHH").
+        """
+        if output_format == "number":
+            return str(self.accent_number())
+        if output_format == "pattern":
+            return "".join("H" if high else "L" for mora, high in self.pitch_pattern())
+        return self.html()
+
+
+def format_entry(e):
+    """ Format an entry from the data in the original database to something that uses html """
+    return AccentPattern.from_entry(e).html()
+
+
+def row_hash(line):
+    """ Key of a row of the original database in the row cache """
+    return hashlib.sha1(line.encode("utf-8")).hexdigest()[:16]
+
+
+def read_row_cache():
+    """ Read the AccentPatterns of the previous build, keyed on row_hash """
+    cache = {}
+    if os.path.exists(row_cache):
+        f = io.open(row_cache, 'r', encoding="utf-8")
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            cache[fields[0]] = AccentPattern.from_fields(fields[1:])
+        f.close()
+    return cache
+
+
+# Commas between braces or parentheses are part of a field, not separators
+field_comma_regex = re.compile(r'\{.*?,.*?\}|\(.*?,.*?\)')
+
+
+def protect_field_commas(match):
+    return match.group(0).replace(',', ';')
+
+
+def parse_row(line):
+    """ Parse a row of the original database into (row_hash, AccentEntry) """
+    line = line.strip()
+    rowkey = row_hash(line)
+    line = field_comma_regex.sub(protect_field_commas, line)
+    return rowkey, AccentEntry._make(line.split(","))
+
+
+def read_entries(path):
+    """ Yield (row_hash, AccentEntry) for every row of the original database """
+    f = io.open(path, 'r', encoding="utf-8")
+    for line in f:
+        yield parse_row(line)
+    f.close()
+
+
+def format_entries(entries, cache):
+    """
+    Yield (row_hash, keys, kana, AccentPattern) for every (row_hash, entry).
+    Entries already in the cache (see read_row_cache) are not parsed again.
+    """
+    for rowkey, e in entries:
+        pattern = cache.get(rowkey)
+        if pattern is None:
+            pattern = AccentPattern.from_entry(e)
+        yield rowkey, (e.nhk, e.kanjiexpr), e.midashigo, pattern
+
+
+def format_rows(rows):
+    """
+    Parse a chunk of (line, cached AccentPattern or None) rows. This runs in
+    the worker processes of a parallel build.
+    """
+    ret = []
+    for line, pattern in rows:
+        rowkey, e = parse_row(line)
+        if pattern is None:
+            pattern = AccentPattern.from_entry(e)
+        ret.append((rowkey, (e.nhk, e.kanjiexpr), e.midashigo, pattern))
+    return ret
+
+
+def format_entries_parallel(path, cache, workers, chunksize=2000):
+    """
+    Same as format_entries(read_entries(path), cache), but the rows are parsed
+    and formatted by a pool of worker processes. The chunks are collected in
+    their original order, so the result does not depend on the scheduling.
+    """
+    def chunks():
+        chunk = []
+        f = io.open(path, 'r', encoding="utf-8")
+        for line in f:
+            chunk.append((line, cache.get(row_hash(line.strip())) if cache else None))
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+        f.close()
+        if chunk:
+            yield chunk
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for formatted in pool.imap(format_rows, chunks()):
+            for row in formatted:
+                yield row
+    finally:
+        pool.close()
+        pool.join()
+
+
+def build_database(cache=None, workers=1):
+    """
+    Build the derived database from the original database. The rows are
+    streamed from the original database to the derivative file one by one;
+    only the lines written so far are kept in memory to skip duplicates.
+
+    With more than one worker, the rows are formatted in a process pool. The
+    output is identical to that of a build with a single worker. Only use
+    that outside of Anki (in the CLI or prepare_release.py): inside Anki this
+    runs on the loader thread, where multiprocessing does not work.
+    """
+    if cache is None:
+        cache = {}
+    written = set()
+
+    if workers > 1:
+        rows = format_entries_parallel(accent_database, cache, workers)
+    else:
+        rows = format_entries(read_entries(accent_database), cache)
+
+    o = io.open(derivative_database, 'w', encoding="utf-8")
+    c = io.open(row_cache, 'w', encoding="utf-8")
+
+    for rowkey, keys, kana, pattern in rows:
+        fields = "\t".join(pattern.fields())
+        c.write("%s\t%s\n" % (rowkey, fields))
+
+        # Add expressions for both, together with the spelling in katakana,
+        # and the pitch accent
+        for key in keys:
+            line = "%s\t%s\t%s\n" % (key, kana, fields)
+            if line not in written:
+                written.add(line)
+                o.write(line)
+
+    c.close()
+    o.close()
+
+
+def read_derivative():
+    """ Read the derivative file to memory, into thedict and reading_dict """
+    f = io.open(derivative_database, 'r', encoding="utf-8")
+
+    for line in f:
+        fields = line.rstrip("\n").split("\t")
+        key = intern_string(fields[0])
+        kana = intern_string(fields[1])
+        pron = AccentPattern.from_fields(fields[2:])
+        kanapron = (kana, pron)
+        if key in thedict:
+            if kanapron not in thedict[key]:
+                thedict[key].append(kanapron)
+        else:
+            thedict[key] = [kanapron]
+
+        reading = katakana_to_hiragana(kana)
+        exprpron = (key, pron)
+        if reading in reading_dict:
+            if exprpron not in reading_dict[reading]:
+                reading_dict[reading].append(exprpron)
+        else:
+            reading_dict[reading] = [exprpron]
+
+    f.close()
+
+
+# Okurigana between two kanji, which is often left out (取り扱い, 取扱い)
+inner_okurigana_regex = re.compile(u'(?<=[\u4e00-\u9fff\u3400-\u4dbf])[\u3041-\u3096]{1,2}(?=[\u4e00-\u9fff\u3400-\u4dbf])', re.U)
+
+
+def normalize_key(expr):
+    """
+    Fold spelling variants of an expression onto the same key: full-width and
+    half-width forms (NFKC), katakana to hiragana, iteration marks written
+    out, okurigana between kanji dropped and a trailing する stripped.
+    """
+    txt = katakana_to_hiragana(unicodedata.normalize("NFKC", expr))
+
+    chars = []
+    for char in txt:
+        if chars and char in u"々ゝヽ":
+            char = chars[-1]
+        elif chars and char in u"ゞヾ":
+            char = unicodedata.normalize("NFC", chars[-1] + u"\u3099")
+        chars.append(char)
+    txt = inner_okurigana_regex.sub(u"", u"".join(chars))
+
+    if len(txt) > 2 and txt.endswith(u"する"):
+        txt = txt[:-2]
+    return txt
+
+
+def build_fuzzy_dict(entries):
+    """
+    Map each normalized key that is shared by a spelling other than itself
+    to the entries of all the spellings with that normalized key.
+    """
+    spellings = {}
+    for key in entries:
+        spellings.setdefault(normalize_key(key), []).append(key)
+
+    fuzzy = {}
+    for norm, keys in spellings.items():
+        if keys == [norm]:
+            continue
+        merged = fuzzy[norm] = []
+        for key in sorted(keys):
+            merged.extend(e for e in entries[key] if e not in merged)
+    return fuzzy
+
+
+# ************************************************
+#                 Binary index                   *
+# ************************************************
+# Layout of the index file (all integers are little-endian):
+#   header:  magic, number of keys, number of values
+#   keys:    (key offset, key length, first value, value count) for every key,
+#            sorted on the UTF-8 encoded key
+#   values:  (string offset, string length, text offset, text length, accent
+#            offset, accent length, nopron mask, nasal mask), where the string
+#            is the kana (or the expression for the reading index) and the
+#            rest is an AccentPattern
+#   strings: UTF-8 encoded blob which all offsets point into. Every distinct
+#            string is stored only once.
+INDEX_MAGIC = b"NHKIDX02"
+_index_header = struct.Struct("<8sII")
+_index_key = struct.Struct("<IIII")
+_index_value = struct.Struct("<IHIHIHQQ")
+
+
+def _replace_file(src, dst):
+    """ Move src over dst (os.replace is not available on Python 2) """
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def write_index(path, entries):
+    """ Write a dict of key -> [(kana, AccentPattern), ...] to a binary index file """
+    strings = io.BytesIO()
+    keys = io.BytesIO()
+    values = io.BytesIO()
+    string_offsets = {}
+
+    def add_string(txt):
+        if txt not in string_offsets:
+            data = txt.encode("utf-8")
+            string_offsets[txt] = (strings.tell(), len(data))
+            strings.write(data)
+        return string_offsets[txt]
+
+    encoded_keys = sorted((key.encode("utf-8"), key) for key in entries)
+    nvalues = 0
+    for encoded, key in encoded_keys:
+        offset = strings.tell()
+        strings.write(encoded)
+        keys.write(_index_key.pack(offset, len(encoded), nvalues, len(entries[key])))
+        for kana, pattern in entries[key]:
+            values.write(_index_value.pack(*(add_string(kana) + add_string(pattern.text) +
+                                             add_string(pattern.accent) + (pattern.nopron, pattern.nasal))))
+            nvalues += 1
+
+    tmp_path = path + ".tmp"
+    o = io.open(tmp_path, 'wb')
+    o.write(_index_header.pack(INDEX_MAGIC, len(encoded_keys), nvalues))
+    o.write(keys.getvalue())
+    o.write(values.getvalue())
+    o.write(strings.getvalue())
+    o.close()
+    _replace_file(tmp_path, path)
+
+
+class PronunciationIndex(object):
+    """
+    Read-only view on an index file written by write_index. The file is memory
+    mapped, so opening it is (nearly) free and the pages are shared between
+    processes. Keys are looked up with a binary search.
+    """
+
+    def __init__(self, path):
+        f = io.open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic, self._nkeys, self._nvalues = _index_header.unpack_from(self._mm, 0)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise IOError("Unsupported index file: %s" % path)
+
+        self._keys_start = _index_header.size
+        self._values_start = self._keys_start + self._nkeys * _index_key.size
+        self._strings_start = self._values_start + self._nvalues * _index_value.size
+
+    def close(self):
+        self._mm.close()
+
+    def _string(self, offset, length):
+        start = self._strings_start + offset
+        return self._mm[start:start + length]
+
+    def _key(self, i):
+        return _index_key.unpack_from(self._mm, self._keys_start + i * _index_key.size)
+
+    def _find(self, key):
+        """ Return the position of key in the key table, or -1 """
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+
+        lo = 0
+        hi = self._nkeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, _, _ = self._key(mid)
+            current = self._string(offset, length)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def _lower_bound(self, key, lo, hi):
+        """ Position of the first key in [lo, hi) that is not smaller than key """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, _, _ = self._key(mid)
+            if self._string(offset, length) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def longest_prefix(self, text, start=0):
+        """
+        Length of the longest key that text[start:] starts with, or 0 if none.
+        The sorted keys are walked like a trie: every next character narrows
+        down the range of keys that share the prefix read so far.
+        """
+        lo = 0
+        hi = self._nkeys
+        prefix = b''
+        best = 0
+        for i in range(start, len(text)):
+            prefix += text[i].encode("utf-8")
+            # UTF-8 never contains 0xff, so all keys starting with prefix sort before prefix + 0xff
+            lo = self._lower_bound(prefix, lo, hi)
+            hi = self._lower_bound(prefix + b'\xff', lo, hi)
+            if lo == hi:
+                break
+
+            _, length, _, _ = self._key(lo)
+            if length == len(prefix):
+                best = i - start + 1
+        return best
+
+    def _values(self, first, count):
+        ret = []
+        for i in range(first, first + count):
+            kana_off, kana_len, text_off, text_len, accent_off, accent_len, nopron, nasal = \
+                _index_value.unpack_from(self._mm, self._values_start + i * _index_value.size)
+            pattern = AccentPattern(self._string(text_off, text_len).decode("utf-8"),
+                                    self._string(accent_off, accent_len).decode("utf-8"),
+                                    nopron, nasal)
+            ret.append((self._string(kana_off, kana_len).decode("utf-8"), pattern))
+        return ret
+
+    def __len__(self):
+        return self._nkeys
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        _, _, first, count = self._key(i)
+        return self._values(first, count)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        for i in range(self._nkeys):
+            offset, length, _, _ = self._key(i)
+            yield self._string(offset, length).decode("utf-8")
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for key in self:
+            yield key, self[key]
+
+
+# ************************************************
+#                 Build manifest                 *
+# ************************************************
+def file_fingerprint(path, previous=None):
+    """
+    Size, modification time and SHA-1 of a file. When size and modification
+    time match the previous fingerprint, its hash is reused instead of reading
+    the whole file again.
+    """
+    st = os.stat(path)
+    if previous and previous.get("size") == st.st_size and previous.get("mtime") == st.st_mtime:
+        return previous
+
+    h = hashlib.sha1()
+    f = io.open(path, 'rb')
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    f.close()
+
+    return {"size": st.st_size, "mtime": st.st_mtime, "sha1": h.hexdigest()}
+
+
+def build_settings():
+    """ Everything besides the source files that determines the generated files """
+    build_config = dict((k, config.get(k)) for k in BUILD_CONFIG_KEYS)
+    config_hash = hashlib.sha1(json.dumps(build_config, sort_keys=True).encode("utf-8")).hexdigest()
+    return {"formatter_version": FORMATTER_VERSION,
+            "normalizer_version": NORMALIZER_VERSION,
+            "index_format": INDEX_MAGIC.decode("ascii"),
+            "config": config_hash}
+
+
+def read_manifest():
+    if not os.path.exists(build_manifest):
+        return {}
+    try:
+        f = io.open(build_manifest, 'r', encoding="utf-8")
+        manifest = json.load(f)
+        f.close()
+    except ValueError:
+        # Corrupt manifest, treat it as missing and rebuild
+        return {}
+    return manifest
+
+
+def write_manifest(manifest):
+    f = io.open(build_manifest, 'w', encoding="utf-8")
+    f.write(u"%s" % json.dumps(manifest, indent=1, sort_keys=True))
+    f.close()
+
+
+def same_content(fingerprint, previous):
+    return bool(previous) and fingerprint["sha1"] == previous.get("sha1")
+
+
+# The index files generated from the derivative database, by manifest name
+index_files = {"index": derivative_index, "reading": reading_index, "fuzzy": fuzzy_index}
+
+
+def index_fingerprints(previous=None):
+    """ The fingerprints of all index files, or None if any of them is missing """
+    previous = previous or {}
+    if not all(os.path.exists(path) for path in index_files.values()):
+        return None
+    return dict((name, file_fingerprint(path, previous.get(name))) for name, path in index_files.items())
+
+
+def same_indexes(fingerprints, previous):
+    return (fingerprints is not None and bool(previous) and
+            all(same_content(fingerprints[name], previous.get(name)) for name in index_files))
+
+
+def prepare_database(workers=1):
+    """
+    Bring the derivative database and its index up to date with the original
+    database, and open the index. Only the steps whose inputs changed since
+    the last run (according to the build manifest) are executed, so the files
+    built by prepare_release.py are used as they are, once their checksums
+    have been verified. workers is passed on to build_database.
+    """
+    global thedict, reading_dict, fuzzy_dict
+
+    # First check that either the original database, or the derivative text file are present:
+    if not os.path.exists(derivative_database) and not os.path.exists(accent_database):
+        raise IOError("Could not locate the original base or the derivative database!")
+
+    previous = read_manifest()
+    manifest = dict(previous)
+    settings = build_settings()
+    settings_changed = manifest.get("settings") != settings
+
+    # (Re)generate the derivative database if the original database changed
+    if os.path.exists(accent_database):
+        source = file_fingerprint(accent_database, manifest.get("source"))
+        if (settings_changed or not os.path.exists(derivative_database) or
+                not same_content(source, manifest.get("source"))):
+            # Formatted rows can only be reused if the formatter did not change
+            same_formatter = manifest.get("settings", {}).get("formatter_version") == FORMATTER_VERSION
+            build_database(read_row_cache() if same_formatter else None, workers)
+        manifest["source"] = source
+
+    # (Re)generate the index if the derivative database changed, or if an
+    # index file is missing or does not match its checksum
+    derivative = file_fingerprint(derivative_database, manifest.get("derivative"))
+    indexes = index_fingerprints(manifest.get("indexes"))
+    if (settings_changed or not same_indexes(indexes, manifest.get("indexes")) or
+            not same_content(derivative, manifest.get("derivative"))):
+        thedict = {}
+        reading_dict = {}
+        read_derivative()
+        write_index(derivative_index, thedict)
+        write_index(reading_index, reading_dict)
+        write_index(fuzzy_index, build_fuzzy_dict(thedict))
+        indexes = index_fingerprints()
+    manifest["derivative"] = derivative
+    manifest["indexes"] = indexes
+
+    manifest["settings"] = settings
+    if manifest != previous:
+        write_manifest(manifest)
+
+    thedict = PronunciationIndex(derivative_index)
+    reading_dict = PronunciationIndex(reading_index)
+    fuzzy_dict = PronunciationIndex(fuzzy_index)
+    render_cache.clear()
+    formatted_cache.clear()
+
+
+# Set once the database is loaded (or failed to load) by load_database
+database_ready = threading.Event()
+database_error = None
+database_loader = None
+
+
+def load_database(workers=1):
+    """ Run prepare_database, remembering any error for ensure_database """
+    global database_error
+    try:
+        prepare_database(workers)
+    except Exception as e:
+        database_error = e
+    finally:
+        database_ready.set()
+
+
+def start_loading_database():
+    """ Load the database in a background thread, so it does not hold up Anki's startup """
+    global database_loader
+    database_loader = threading.Thread(target=load_database, name="nhk_pronunciation loader")
+    database_loader.daemon = True
+    database_loader.start()
+
+
+def ensure_database(workers=1):
+    """
+    Wait until the database is loaded, or load it now if that was not started
+    yet, building it with workers processes if needed. Lookups call this
+    before using it.
+    """
+    if not database_ready.is_set():
+        if database_loader is None:
+            load_database(workers)
+        database_ready.wait()
+    if database_error is not None:
+        raise database_error
+
+
+# ************************************************
+#              Lookup server client              *
+# ************************************************
+class LookupClient(object):
+    """
+    Client of a lookup server (nhk_pronunciation_server.py), at an address
+    like "localhost:5719" or "unix:/path/to/socket". Requests return None if
+    the server cannot be reached, so callers can fall back to looking up
+    themselves; connecting is then retried after retry seconds.
+    """
+
+    def __init__(self, address, timeout=30, retry=60):
+        self.address = address
+        self.timeout = timeout
+        self.retry = retry
+        self._sock = None
+        self._file = None
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.address.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            target = self.address[len("unix:"):]
+        else:
+            host, port = self.address.rsplit(":", 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            target = (host, int(port))
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(target)
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+        self._file = sock.makefile("rb")
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = None
+            self._file = None
+
+    def request(self, method, **params):
+        """ Send a request to the server and return its response, or None on failure """
+        params["method"] = method
+        line = json.dumps(params).encode("utf-8") + b"\n"
+        with self._lock:
+            if self._sock is None and time.time() < self._retry_at:
+                return None
+            try:
+                if self._sock is None:
+                    self._connect()
+                self._sock.sendall(line)
+                response = self._file.readline()
+                if not response:
+                    raise IOError("Connection closed by the lookup server")
+                response = json.loads(response.decode("utf-8"))
+            except (IOError, OSError, ValueError, socket.error):
+                self.close()
+                self._retry_at = time.time() + self.retry
+                return None
+
+        if "error" in response:
+            return None
+        return response
+
+    def getPronunciations(self, exprs, sanitize=True):
+        """
+        getPronunciations of each of exprs without the style config applied,
+        so the caller can apply its own, or None on failure
+        """
+        response = self.request("getPronunciations", exprs=exprs, sanitize=sanitize, styled=False)
+        if response is None:
+            return None
+        return [OrderedDict((expr, prons) for expr, prons in result) for result in response["results"]]
+
+
+# ************************************************
+#              Lookup Functions                  *
+# ************************************************
+@stats.timed("inline_style")
+def inline_style(txt):
+    """ Map style classes to their inline version """
+
+    for k, v in config["styles"].items():
+        txt = txt.replace(k, v)
+
+    return txt
+
+
+# Rendered (unstyled) pronunciations of the keys of thedict that have been
+# looked up. They only depend on the database, so the cache is cleared when
+# it is (re)loaded.
+render_cache = {}
+
+# The styled version of every rendered pronunciation. It depends on the
+# "styles" and "pronunciationHiragana" config, so the cache is cleared
+# whenever the config changes (see configure).
+style_cache = {}
+
+
+def rendered_pronunciations(expr):
+    """
+    Return the list of unique pronunciations of a key of thedict as html
+    without the style config applied (see style_html), or None if it is not
+    in the dictionary. The returned list is shared between calls and should
+    not be modified.
+    """
+    rendered = render_cache.get(expr)
+    if rendered is not None:
+        return rendered
+
+    entries = thedict.get(expr)
+    if entries is None:
+        return None
+
+    rendered = render_entries(entries)
+    render_cache[expr] = rendered
+    return rendered
+
+
+def render_entries(entries):
+    """ The unique, rendered pronunciations of a list of (kana, AccentPattern) entries """
+    rendered = []
+    for kana, pattern in entries:
+        html = pattern.html()
+        if html not in rendered:
+            rendered.append(html)
+    return rendered
+
+
+def style_html(html):
+    """ Apply the style (and hiragana) config to a pronunciation rendered by AccentPattern.html """
+    inlinepron = style_cache.get(html)
+    if inlinepron is None:
+        inlinepron = inline_style(html)
+        if config["pronunciationHiragana"]:
+            inlinepron = katakana_to_hiragana(inlinepron)
+        style_cache[html] = inlinepron
+    return inlinepron
+
+
+def style_pronunciation(pattern):
+    """ Render an AccentPattern from the database as html, with the style (and hiragana) config applied """
+    return style_html(pattern.html())
+
+
+def style_results(ret):
+    """ Apply the style config to the rendered pronunciations of a lookup, as returned by _getPronunciations """
+    styled = OrderedDict()
+    for expr, rendered in ret.items():
+        styled_prons = styled[expr] = []
+        for html in rendered:
+            inlinepron = style_html(html)
+            if inlinepron not in styled_prons:
+                styled_prons.append(inlinepron)
+    return styled
+
+
+def getPronunciationsByReading(reading):
+    """
+    Search the pronunciations of all expressions with a particular reading,
+    in hiragana or katakana.
+
+    Returns a dictionary mapping each expression with that reading to a list
+    of html-styled pronunciations.
+    """
+    ensure_database()
+    ret = OrderedDict()
+    for expr, pattern in reading_dict.get(katakana_to_hiragana(reading.strip()), []):
+        inlinepron = style_pronunciation(pattern)
+        styled_prons = ret.setdefault(expr, [])
+        if inlinepron not in styled_prons:
+            styled_prons.append(inlinepron)
+    return ret
+
+
+kana_regex = re.compile(u'^[\u3040-\u30ff]+$', re.U)
+
+
+def is_known_reading(expr):
+    return bool(kana_regex.match(expr)) and katakana_to_hiragana(expr) in reading_dict
+
+
+def reading_pronunciations(expr):
+    """ All rendered pronunciations of a reading, without the expressions they belong to """
+    rendered = []
+    for _, pattern in reading_dict.get(katakana_to_hiragana(expr.strip()), []):
+        html = pattern.html()
+        if html not in rendered:
+            rendered.append(html)
+    return rendered
+
+
+def fuzzy_pronunciations(expr):
+    """
+    The rendered pronunciations of a spelling variant of a dictionary word or
+    reading (see normalize_key), or None if expr is not one.
+    """
+    norm = normalize_key(expr)
+    entries = fuzzy_dict.get(norm)
+    if entries is not None:
+        return render_entries(entries)
+
+    if norm != expr:
+        rendered = rendered_pronunciations(norm)
+        if rendered is not None:
+            return rendered
+        if is_known_reading(norm):
+            return reading_pronunciations(norm)
+    return None
+
+
+def use_fallbacks(expr, recurse=True):
+    """
+    Whether getPronunciations may look expr up by its reading or as a
+    spelling variant. Not for the parts found by Mecab or dictionary_split
+    (which are looked up without recurse), nor for a single kana: those are
+    mostly particles, which would get the pronunciations of homophones.
+    """
+    return recurse and not (len(expr) == 1 and kana_regex.match(expr))
+
+
+def is_known(expr):
+    """ Whether getPronunciations finds expr without splitting it """
+    if expr in thedict:
+        return True
+    return use_fallbacks(expr) and (is_known_reading(expr) or fuzzy_pronunciations(expr) is not None)
+
+
+def use_dictionary_split(before_mecab):
+    """ Whether dictionary_split should be tried before (or after) Mecab, according to the config """
+    mode = config["dictionarySplit"]
+    if before_mecab:
+        return mode == "beforeMecab"
+    return mode == "noMecab" and not lookup_mecab
+
+
+def dictionary_split(expr):
+    """
+    Split an expression into words of the dictionary without Mecab, by taking
+    the longest word the text starts with, from left to right. Characters that
+    do not start any word are skipped, as are single kana (mostly particles).
+    """
+    if not isinstance(thedict, PronunciationIndex):
+        return []
+
+    words = []
+    i = 0
+    while i < len(expr):
+        length = thedict.longest_prefix(expr, i)
+        word = expr[i:i + length]
+        if length > 1 or (length == 1 and not kana_regex.match(word)):
+            words.append(word)
+            i += length
+        else:
+            i += 1
+    return words
+
+
+@stats.timed("getPronunciations")
+def getPronunciations(expr, sanitize=True, recurse=True):
+    """
+    Search pronuncations for a particular expression
+
+    Returns a dictionary mapping the expression (or sub-expressions contained
+    in the expression) to a list of html-styled pronunciations.
+    """
+    if lookup_client is not None and recurse:
+        results = lookup_client.getPronunciations([expr], sanitize)
+        if results is not None:
+            stats.count("lookup.server")
+            return style_results(results[0])
+
+    ensure_database()
+    ret, outcome = _getPronunciations(expr, sanitize, recurse)
+    stats.count("lookup." + outcome)
+    return style_results(ret)
+
+
+def _getPronunciations(expr, sanitize=True, recurse=True, readings=None):
+    """
+    getPronunciations without the statistics and the style config, which it
+    calls recursively for parts of the expression. Returns the rendered
+    pronunciations (see style_results) and how they were found: "direct", "reading", "fuzzy", "split", "dictionary_split", "mecab"
+    or "miss". readings can hold Mecab readings fetched in advance with
+    MecabPool.prefetch, by expression.
+    """
+    # Sanitize input
+    if sanitize:
+        expr = strip_html_markup(expr)
+        expr = expr.strip()
+
+    ret = OrderedDict()
+    rendered = rendered_pronunciations(expr)
+    if rendered is not None:
+        outcome = "direct"
+    elif not use_fallbacks(expr, recurse):
+        outcome = "miss"
+    elif is_known_reading(expr):
+        # A reading without a matching spelling, e.g. in katakana
+        rendered = reading_pronunciations(expr)
+        outcome = "reading"
+    else:
+        # A different spelling of a word in the dictionary, e.g. in half-width katakana
+        rendered = fuzzy_pronunciations(expr)
+        outcome = "fuzzy"
+
+    if rendered is not None:
+        ret[expr] = rendered
+        return ret, outcome
+
+    if not recurse:
+        return ret, "miss"
+
+    # Try to split the expression in various ways, and check if any of those results
+    split_expr = split_separators(expr)
+
+    if len(split_expr) > 1:
+        for sub_expr in split_expr:
+            ret.update(_getPronunciations(sub_expr, sanitize, True, readings)[0])
+        if ret:
+            return ret, "split"
+
+    # Split on the longest words in the dictionary, unless Mecab should try first
+    if use_dictionary_split(before_mecab=True):
+        for sub_expr in dictionary_split(expr):
+            ret.update(_getPronunciations(sub_expr, sanitize, False)[0])
+        if ret:
+            return ret, "dictionary_split"
+
+    # Only if lookups were not succesful, we try splitting with Mecab
+    if lookup_mecab:
+        reading = readings.get(expr) if readings else None
+        if reading is None:
+            reading = mecab_reader.reading(expr)
+        for sub_expr in reading.split():
+            # Avoid infinite recursion by saying that we should not try
+            # Mecab again if we do not find any matches for this sub-
+            # expression.
+            ret.update(_getPronunciations(sub_expr, sanitize, False)[0])
+        if ret:
+            return ret, "mecab"
+
+    if use_dictionary_split(before_mecab=False):
+        for sub_expr in dictionary_split(expr):
+            ret.update(_getPronunciations(sub_expr, sanitize, False)[0])
+        if ret:
+            return ret, "dictionary_split"
+
+    return ret, "miss"
+
+
+@stats.timed("getPronunciationsBatch")
+def getPronunciationsBatch(exprs, sanitize=True, styled=True):
+    """
+    getPronunciations of each of a list of expressions, in the same order.
+    Every distinct expression is looked up once: first all of them directly
+    in the dictionary, and then the others, with one Mecab call for all the
+    text that needs it. Without styled, the pronunciations are returned
+    without the style config applied, as by _getPronunciations.
+    """
+    if lookup_client is not None:
+        unique = list(OrderedDict.fromkeys(exprs))
+        results = lookup_client.getPronunciations(unique, sanitize)
+        if results is not None:
+            stats.count("lookup.server", len(unique))
+            if styled:
+                results = [style_results(result) for result in results]
+            found = dict(zip(unique, results))
+            return [found[expr] for expr in exprs]
+
+    ensure_database()
+
+    # Sanitize every distinct expression, and look up the sanitized ones
+    cleaned = {}
+    for expr in exprs:
+        if expr not in cleaned:
+            cleaned[expr] = strip_html_markup(expr).strip() if sanitize else expr
+
+    found = {}
+    todo = []
+    for clean in OrderedDict.fromkeys(cleaned.values()):
+        rendered = rendered_pronunciations(clean)
+        if rendered is not None:
+            found[clean] = OrderedDict([(clean, rendered)])
+            stats.count("lookup.direct")
+        else:
+            todo.append(clean)
+
+    readings = None
+    if todo and lookup_mecab:
+        readings = mecab_reader.prefetch([q for clean in todo for q in mecab_queries(clean, False)])
+    for clean in todo:
+        found[clean], outcome = _getPronunciations(clean, False, True, readings)
+        stats.count("lookup." + outcome)
+
+    if styled:
+        for clean, ret in found.items():
+            found[clean] = style_results(ret)
+    return [found[cleaned[expr]] for expr in exprs]
+
+
+def mecab_queries(expr, sanitize=True):
+    """
+    The expressions getPronunciations(expr, sanitize) will most likely pass to
+    Mecab, so their readings can be prefetched in one batch.
+    """
+    ensure_database()
+    if sanitize:
+        expr = strip_html_markup(expr)
+        expr = expr.strip()
+
+    if is_known(expr):
+        return []
+
+    queries = []
+    found = False
+    split_expr = split_separators(expr)
+    if len(split_expr) > 1:
+        for sub_expr in split_expr:
+            if is_known(sub_expr):
+                found = True
+            else:
+                queries.extend(mecab_queries(sub_expr, sanitize))
+
+    if not found and use_dictionary_split(before_mecab=True) and dictionary_split(expr):
+        found = True
+
+    if not found:
+        queries.append(expr)
+    return queries
+
+
+# Results of getFormattedPronunciations, cleared whenever the dictionary or the
+# config is (re)loaded
+formatted_cache = LRUCache(config["formattedCacheSize"], config["formattedCacheTTL"])
+
+
+def getFormattedPronunciations(expr, sep_single=" *** ", sep_multi="<br/>\n", expr_sep=None, sanitize=True):
+    options = (sep_single, sep_multi, expr_sep, sanitize)
+    txt = formatted_cache.get((expr,) + options)
+    if txt is None:
+        txt = lookup_formatted([expr], options)[0]
+
+    return txt
+
+
+def getFormattedPronunciationsBatch(exprs, sep_single=" *** ", sep_multi="<br/>\n", expr_sep=None, sanitize=True):
+    """ getFormattedPronunciations of each of a list of expressions, looking up the uncached ones with getPronunciationsBatch """
+    options = (sep_single, sep_multi, expr_sep, sanitize)
+    found = {}
+    todo = []
+    for expr in exprs:
+        if expr not in found:
+            found[expr] = txt = formatted_cache.get((expr,) + options)
+            if txt is None:
+                todo.append(expr)
+
+    if todo:
+        found.update(zip(todo, lookup_formatted(todo, options)))
+
+    return [found[expr] for expr in exprs]
+
+
+def lookup_formatted(exprs, options):
+    """ Look up exprs with getPronunciationsBatch, and format and cache the results """
+    sep_single, sep_multi, expr_sep, sanitize = options
+    txts = []
+    for expr, prons in zip(exprs, getPronunciationsBatch(exprs, sanitize)):
+        txt = format_pronunciations(prons, sep_single, sep_multi, expr_sep)
+        formatted_cache.put((expr,) + options, txt)
+        txts.append(txt)
+    return txts
+
+
+def format_pronunciations(prons, sep_single, sep_multi, expr_sep):
+    """ Join the result of getPronunciations into a single string """
+
+    single_merge = OrderedDict()
+    for k, v in prons.items():
+        single_merge[k] = sep_single.join(v)
+
+    if expr_sep:
+        txt = sep_multi.join([u"{}{}{}".format(k, expr_sep, v) for k, v in single_merge.items()])
+    else:
+        txt = sep_multi.join(single_merge.values())
+
+    return txt
+
+
+def lookup_stats_report():
+    """ All statistics, including those of the caches """
+    report = stats.snapshot()
+    report["caches"] = {
+        "formatted": {"size": len(formatted_cache), "hits": formatted_cache.hits, "misses": formatted_cache.misses},
+        "rendered": {"size": len(render_cache)},
+    }
+    return report
+
+
+def configure(new_config):
+    """ Use a new config, and drop everything derived from the old one """
+    global config, lookup_client
+    config = new_config
+    if lookup_client is not None and lookup_client.address != config["lookupServer"]:
+        lookup_client.close()
+        lookup_client = None
+    if config["lookupServer"] and lookup_client is None:
+        lookup_client = LookupClient(config["lookupServer"])
+    stats.enabled = config["instrumentation"]
+    style_cache.clear()
+    formatted_cache.clear()
+    formatted_cache.maxsize = config["formattedCacheSize"]
+    formatted_cache.ttl = config["formattedCacheTTL"]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Local pronunciation lookup server, so several programs can share one loaded
+dictionary and one Mecab pool. Listens on a Unix socket or a localhost port.
+
+Usage: python nhk_pronunciation_server.py [--socket PATH | --port PORT] [--mecab DIR]
+
+The protocol is one JSON object per line in each direction. A request has a
+"method" and its parameters, and may have an "id" that is copied into the
+response:
+
+    {"id": 1, "method": "getPronunciations", "exprs": ["日本語", "橋"], "sanitize": true}
+    {"id": 1, "results": [[["日本語", ["..."]]], [["橋", ["...", "..."]]]]}
+
+    {"method": "getFormattedPronunciations", "exprs": ["日本語"], "sep_single": " *** "}
+    {"results": ["..."]}
+
+    {"method": "stats"}
+    {"results": {...}}
+
+getPronunciations results are lists of [expression, pronunciations] pairs,
+to keep their order. The pronunciations are styled with the server's config,
+unless the request has "styled": false: then the client applies its own
+"styles" and "pronunciationHiragana" (see core.style_results), as the add-on
+does. getFormattedPronunciations always uses the server's config. Failed
+requests get {"error": "..."} instead. Point the add-on at the server with its
+"lookupServer" config option. Needs Python 3.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+
+import nhk_pronunciation_core as core
+
+# Requests can hold many expressions, so allow long lines
+MAX_LINE = 64 * 1024 * 1024
+
+
+def lookup(request):
+    """ Handle a request, in one of the executor's threads """
+    method = request.get("method")
+    exprs = request.get("exprs", [])
+
+    if method == "getPronunciations":
+        results = core.getPronunciationsBatch(exprs, request.get("sanitize", True), request.get("styled", True))
+        return [list(prons.items()) for prons in results]
+    elif method == "getFormattedPronunciations":
+        options = dict((k, request[k]) for k in ("sep_single", "sep_multi", "expr_sep", "sanitize") if k in request)
+        return core.getFormattedPronunciationsBatch(exprs, **options)
+    elif method == "stats":
+        return core.lookup_stats_report()
+
+    raise ValueError("Unknown method %r" % method)
+
+
+async def serve_client(reader, writer, executor):
+    """ Answer the requests of one client, in order """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            request = {}
+            try:
+                request = json.loads(line.decode("utf-8"))
+                response = {"results": await loop.run_in_executor(executor, lookup, request)}
+            except Exception as e:
+                response = {"error": "%s: %s" % (type(e).__name__, e)}
+            if isinstance(request, dict) and "id" in request:
+                response["id"] = request["id"]
+
+            writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        # Disconnected, or a line longer than MAX_LINE
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args, executor):
+    handler = functools.partial(serve_client, executor=executor)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = await asyncio.start_unix_server(handler, args.socket, limit=MAX_LINE)
+        where = "unix:%s" % args.socket
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port, limit=MAX_LINE)
+        where = "%s:%d" % (args.host, args.port)
+
+    sys.stderr.write("NHK pronunciation server listening on %s\n" % where)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--socket", default=None, help="listen on this Unix socket instead of a port")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=5719, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=4, help="number of requests looked up at the same time")
+    parser.add_argument("--config", default=None, help="config file (default: the add-on's config.json)")
+    parser.add_argument("--mecab", default=None,
+                        help="support folder of the Japanese add-on, to look up what is not in the dictionary with Mecab")
+    args = parser.parse_args()
+
+    config = core.read_config(args.config)
+    config["useMecab"] = bool(args.mecab)
+    # The server does the lookups itself
+    config["lookupServer"] = ""
+    core.configure(config)
+    if args.mecab:
+        core.setup_mecab(args.mecab)
+    core.ensure_database()
+
+    executor = concurrent.futures.ThreadPoolExecutor(args.threads)
+    try:
+        asyncio.run(serve(args, executor))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(wait=False)
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,47 @@
-from zipfile import ZipFile
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from zipfile import ZipFile, ZIP_DEFLATED
 
-with ZipFile('release_20.zip', 'w') as z:
+# Build the derivative database and its indexes in a clean folder, so the
+# releases ship them (with the manifest holding their checksums) and users do
+# not have to build them on their first start. The index format does not
+# depend on the Python version, so both releases get the same files. The
+# rows are formatted by one process per CPU; the result is the same as that
+# of the serial build done inside Anki.
+build_dir = tempfile.mkdtemp(prefix="nhk_release_")
+for name in ['ACCDB_unicode.csv', 'config.json', 'nhk_pronunciation_core.py']:
+    shutil.copy(name, build_dir)
+subprocess.check_call([sys.executable, '-c', 'import multiprocessing; import nhk_pronunciation_core as core; '
+                                        'core.ensure_database(multiprocessing.cpu_count())'],
+                      cwd=build_dir)
+
+prebuilt = ['nhk_pronunciation.csv', 'nhk_pronunciation.idx', 'nhk_pronunciation.reading.idx',
+            'nhk_pronunciation.fuzzy.idx', 'nhk_pronunciation.manifest.json']
+
+
+def write_prebuilt(z):
+    for name in prebuilt:
+        z.write(os.path.join(build_dir, name), name)
+
+
+with ZipFile('release_20.zip', 'w', ZIP_DEFLATED) as z:
     z.write('ACCDB_unicode.csv')
     z.write('config.json', 'nhk_pronunciation_config.json')
     z.write('config.md', 'nhk_pronunciation_config.md')
     z.write('nhk_pronunciation.py')
+    z.write('nhk_pronunciation_core.py')
+    write_prebuilt(z)
 
-with ZipFile('release_21.zip', 'w') as z:
+with ZipFile('release_21.zip', 'w', ZIP_DEFLATED) as z:
     z.write('__init__.py')
     z.write('ACCDB_unicode.csv')
     z.write('config.json')
     z.write('config.md')
     z.write('nhk_pronunciation.py')
+    z.write('nhk_pronunciation_core.py')
+    write_prebuilt(z)
+
+shutil.rmtree(build_dir)